@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+from vm5k.engine import *
+import os
+import re
+from execo import Timer, SshProcess
+
+
+class DiskTuning(vm5k_engine_para):
+    """Benchmark the disk cache mode, io mode and qcow2 options of the VMs,
+    by measuring their boot time and the throughput of dd in the VMs. The
+    disks are overlays of the backing file or real files, and only the
+    real files are preallocated, as qemu-img does not preallocate an
+    overlay before 4.2."""
+    def __init__(self):
+        super(DiskTuning, self).__init__()
+        self.n_nodes = 1
+        self.options_parser.add_option("--vm", dest="n_vm",
+                                       type="int", default=4,
+                                       help="maximum number of VMs")
+        self.options_parser.add_option("--io-uring", dest="io_uring",
+                                       action="store_true", default=False,
+                                       help="explore the io_uring io mode, " +
+                                       "that requires qemu >= 5.0 and " +
+                                       "libvirt >= 6.3 on the hosts")
+
+    def define_parameters(self):
+        """Define the parameters you want to explore"""
+        parameters = {
+            'n_vm':           sorted(set([1, self.options.n_vm])),
+            'disk_cache':     ['none', 'writeback', 'directsync', 'unsafe'],
+            'disk_io':        ['native', 'threads'] +
+                              (['io_uring'] if self.options.io_uring else []),
+            'cluster_size':   [65536, 2097152],
+            'real_file':      [False, True],
+            'preallocation':  ['off', 'metadata'],
+            'lazy_refcounts': [False, True],
+            'iteration':      range(1, 4)}
+
+        logger.info('Exploring the following parameters \n%s',
+                    pformat(parameters))
+
+        return parameters
+
+    def comb_nvm(self, comb):
+        """Return the number of virtual machines of the combination"""
+        return comb['n_vm']
+
+    def create_paramsweeper(self):
+        """Skip the combinations that cannot be run, as native io requires
+        the host page cache to be bypassed and an overlay cannot be
+        preallocated"""
+        super(DiskTuning, self).create_paramsweeper()
+        for comb in self.sweeper.get_remaining():
+            if (comb['disk_io'] == 'native' and
+                    comb['disk_cache'] not in ['none', 'directsync']) or \
+                    (comb['preallocation'] != 'off' and
+                     not comb['real_file']):
+                logger.detail('Skipping ' + slugify(comb))
+                self.sweeper.skip(comb)
+
+    def workflow(self, comb, hosts, ip_mac):
+        """Boot the VMs with the disk options of the combination and run
+        the dd benchmarks in them"""
+        host = hosts[0]
+        thread_name = style.Thread(host.split('.')[0]) + ': '
+
+        comb_ok = False
+        try:
+            logger.info(style.step(' Performing combination') + '\n' +
+                        slugify(comb))
+            destroy_vms(hosts, undefine=True)
+            SshProcess('rm -f /tmp/vm-*.qcow2 ; sync ; '
+                       'echo 3 > /proc/sys/vm/drop_caches', host).run()
+
+            vms = define_vms(['vm-' + str(i) for i in range(comb['n_vm'])],
+                             host=host,
+                             ip_mac=ip_mac,
+                             backing_file=self.options.backing_files.split(',')[0],
+                             real_file=comb['real_file'],
+                             disk_cache=comb['disk_cache'],
+                             disk_io=comb['disk_io'],
+                             cluster_size=comb['cluster_size'],
+                             preallocation=comb['preallocation'],
+                             lazy_refcounts=comb['lazy_refcounts'])
+            create = create_disks(vms).run()
+            if not create.ok:
+                logger.error('Unable to create the VMS disks for %s ',
+                             slugify(comb))
+                return
+            install = install_vms(vms).run()
+            if not install.ok:
+                logger.error('Unable to install the VMS for %s ',
+                             slugify(comb))
+                return
+
+            boot_timer = Timer()
+            start_vms(vms).run()
+            if not wait_vms_have_started(vms):
+                logger.error('Unable to boot all the VMS for %s',
+                             slugify(comb))
+                return
+            boot_duration = boot_timer.elapsed()
+
+            bench = TaktukRemote(
+                'dd if=/dev/zero of=/root/dd.bench bs=1M count=1024 '
+                'oflag=direct 2>&1 | tail -n 1 ; '
+                'sync ; echo 3 > /proc/sys/vm/drop_caches ; '
+                'dd if=/root/dd.bench of=/dev/null bs=1M iflag=direct '
+                '2>&1 | tail -n 1 ; '
+                'dd if=/dev/zero of=/root/dd.bench bs=4k count=4096 '
+                'oflag=dsync conv=notrunc 2>&1 | tail -n 1 ; '
+                'rm -f /root/dd.bench',
+                [vm['ip'] for vm in vms]).run()
+            if not bench.ok:
+                logger.error('Unable to run the benchmarks for %s',
+                             slugify(comb))
+                return
+
+            comb_ok = self.save_results(comb, vms, bench, boot_duration)
+
+        finally:
+            if comb_ok:
+                self.sweeper.done(comb)
+                logger.info(thread_name + slugify(comb) +
+                            ' has been done')
+            else:
+                self.sweeper.cancel(comb)
+                logger.warning(thread_name + slugify(comb) +
+                               ' has been canceled')
+            logger.info(style.step('%s Remaining'),
+                        len(self.sweeper.get_remaining()))
+
+    def save_results(self, comb, vms, bench, boot_duration):
+        """Write the boot duration and the MB/s of the sequential write,
+        sequential read and synchronous 4k write of each VM"""
+        comb_dir = self.result_dir + '/' + slugify(comb) + '/'
+        if not os.path.exists(comb_dir):
+            os.mkdir(comb_dir)
+        units = {'B/s': 10 ** -6, 'kB/s': 10 ** -3, 'MB/s': 1,
+                 'GB/s': 10 ** 3}
+        vms_ids = {vm['ip']: vm['id'] for vm in vms}
+        with open(comb_dir + 'disk_bench.txt', 'w') as f:
+            f.write('vm,boot,seq_write,seq_read,sync_write\n')
+            for p in bench.processes:
+                rates = ['%.1f' % (float(rate.replace(',', '.')) *
+                                   units[unit])
+                         for rate, unit in re.findall(r'([\d.,]+) ([kMG]?B/s)',
+                                                      p.stdout)]
+                if len(rates) != 3:
+                    logger.error('Unable to parse the dd output of %s\n%s',
+                                 p.host.address, p.stdout)
+                    return False
+                f.write(','.join([vms_ids[p.host.address],
+                                  '%.1f' % boot_duration] + rates) + '\n')
+        return True
+
+
+if __name__ == "__main__":
+    engine = DiskTuning()
+    engine.start()
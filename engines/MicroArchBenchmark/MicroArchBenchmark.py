@@ -1,6 +1,7 @@
 #!/usr/bin/env python
 from vm5k.engine import *
 from itertools import product, repeat
+from execo import SshProcess
 
 
 class MicroArchBenchmark(vm5k_engine_para):
@@ -1,6 +1,6 @@
 from vm5k.engine import *
 from itertools import product
-import xml.etree.ElementTree as ET
+from execo import SshProcess
 import socket
 
 
@@ -82,27 +82,7 @@ class MicroarchMigration(vm5k_engine):
         return True
         
     def get_cpu_topology(self, cluster):
-        logger.info('Determining the architecture of cluster '+style.emph(cluster))
-        frontend = get_cluster_site(cluster)            
-        submission = OarSubmission(resources = "{'cluster=\""+cluster+"\"'}/nodes=1",
-                                                         walltime = "0:02:00",
-                                                         job_type = "allow_classic_ssh")
-        ((job_id, _), ) = oarsub([(submission, frontend)])
-        wait_oar_job_start( job_id, frontend )        
-        host = get_oar_job_nodes( job_id, frontend )[0]
-        capa = SshProcess('virsh capabilities', host, 
-                          connection_params = {'user': default_frontend_connection_params['user'] }).run()
-        oardel( [ (job_id, frontend) ] )
-        root = ET.fromstring( capa.stdout() )
-        cpu_topology = []
-        i_cell = 0
-        for cell in root.findall('.//cell'):
-            cpu_topology.append([])
-            for cpu in cell.findall('.//cpu'):
-                cpu_topology[i_cell].append(int(cpu.attrib['id']))
-            i_cell += 1
-        
-        return cpu_topology
+        return get_cpu_topology(cluster)
 
     def mem_update(self, vms, size, speed):
         """Copy, compile memtouch, calibrate and return memtouch action """
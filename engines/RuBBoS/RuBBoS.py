@@ -3,6 +3,8 @@ from vm5k.engine import *
 from shutil import copy2
 from os import rename, mkdir, listdir, remove, fdopen, rmdir
 from tempfile import mkstemp
+from execo import SshProcess
+from vm5k import enable_net_queues
 
 
 class RuBBoS(vm5k_engine_para):
@@ -153,7 +155,9 @@ class RuBBoS(vm5k_engine_para):
                         cpusets=cpusets,
                         mem=mems,
                         hdd=disks,
-                        backing_file=backing_files)
+                        backing_file=backing_files,
+                        net_queues='auto',
+                        net_driver='vhost')
             logger.detail('VMS %s ', pformat(vms))
             # Create disks, install vms and boot by core
             logger.info(thread_name + 'Creating disks')
@@ -423,6 +427,8 @@ def boot_vms_list(vms_to_boot):
 
     if not booted:
         return False
+    if not enable_net_queues(vms_to_boot).run().ok:
+        logger.warning('Unable to enable the network queues of the VMs')
 
     booted_vms = len(vms_to_boot)
     logger.info(style.emph(str(booted_vms)))
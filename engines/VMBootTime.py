@@ -5,7 +5,9 @@ import string
 import random
 import os
 from vm5k.utils import get_hosts_jobs, reboot_hosts
-from execo import logger as exlog
+from vm5k.actions import define_golden_vms, save_golden_vms, restore_vms, \
+    static_network_seed
+from execo import logger as exlog, Timer, SshProcess
 
 
 class VMBootMeasurement(vm5k_engine_para):
@@ -36,6 +38,8 @@ class VMBootMeasurement(vm5k_engine_para):
             'cpu_policy':     ['one_core', 'one_by_core'],
             'image_policy':   ['one', 'one_per_vm'],
             'boot_policy':    ['all_at_once', 'one_then_others'],
+            'boot_mode':      ['cold', 'snapshot'],
+            'vms_network':    ['dhcp', 'static'],
             'load_injector':  ['cpu', 'memory', 'mixed'],
             'iteration':      range(1, 3)}
 
@@ -58,6 +62,13 @@ class VMBootMeasurement(vm5k_engine_para):
 
         thread_name = style.Thread(host.split('.')[0]) + ': '
 
+        # all the VMs are restored at once in snapshot mode
+        if comb['boot_mode'] == 'snapshot' and \
+                comb['boot_policy'] != 'all_at_once':
+            logger.info(thread_name + 'Skipping ' + slugify(comb))
+            self.sweeper.skip(comb)
+            return
+
         comb_ok = False
 
         try:
@@ -110,7 +121,21 @@ class VMBootMeasurement(vm5k_engine_para):
             logger.info('Booting xpvms %s\n%s', comb['boot_policy'],
                         "\n".join([vm['id'] + ': ' + vm['ip']
                                    for vm in xpvms]))
-            if comb['boot_policy'] == 'all_at_once':
+            if comb['boot_mode'] == 'snapshot':
+                # the golden VMs are booted and saved before the timer
+                goldens = define_golden_vms(xpvms)
+                if not save_golden_vms(goldens):
+                    logger.error('Unable to save the golden VMs for %s',
+                                 slugify(comb))
+                    exit()
+            boot_timer = Timer()
+            if comb['boot_mode'] == 'snapshot':
+                if not restore_vms(xpvms, goldens).run().ok:
+                    logger.error('Unable to restore the VMs for %s',
+                                 slugify(comb))
+                    return
+                booted = wait_vms_have_started(xpvms, restart=False)
+            elif comb['boot_policy'] == 'all_at_once':
                 start_vms(xpvms)
                 booted = wait_vms_have_started(xpvms)
             else:
@@ -121,15 +146,26 @@ class VMBootMeasurement(vm5k_engine_para):
                     other_vms = xpvms[1:]
                     start_vms(other_vms)
                     booted = wait_vms_have_started(other_vms)
+            # time until all the xpvms are reachable by ssh
+            wall_duration = boot_timer.elapsed()
 
-            # Retrieves measurements on XPVms
-            boot_duration = self.get_boot_duration(xpvms)
-            if not self.save_results(host, comb, xpvms, boot_duration):
+            # Retrieves measurements on XPVms, the in-guest boot time does
+            # not exist for restored VMs, only the wall time is comparable
+            if comb['boot_mode'] == 'snapshot':
+                boot_duration = None
+            else:
+                boot_duration = self.get_boot_duration(xpvms)
+            if not self.save_results(host, comb, xpvms, boot_duration,
+                                     wall_duration):
                 exit()
 
             comb_ok = True
 
         finally:
+            if comb['boot_mode'] == 'snapshot':
+                destroy_vms(hosts, undefine=True)
+                SshProcess('rm -f /tmp/golden-*.qcow2 /tmp/golden-*.state',
+                           host).run()
             if comb_ok:
                 self.sweeper.done(comb)
                 logger.info(thread_name + slugify(comb) +
@@ -162,7 +198,8 @@ class VMBootMeasurement(vm5k_engine_para):
             boot_duration[p.host.address] = p.stdout.strip()[0:-1]
         return boot_duration
 
-    def save_results(self, host, comb, vms, boot_duration):
+    def save_results(self, host, comb, vms, boot_duration,
+                     wall_duration=None):
         # Gathering results
         comb_dir = self.result_dir + '/' + slugify(comb) + '/'
         if not os.path.exists(comb_dir):
@@ -174,12 +211,15 @@ class VMBootMeasurement(vm5k_engine_para):
                 remove(comb_dir + f)
 
         logger.info('Writing boot time in result files')
-        print boot_duration
-        text_file = open(comb_dir + "boot_time.txt", "w")
-        for vm in vms:
-            text_file.write(boot_duration[vm['ip']] + ',' + vm['cpuset']
-                            + '\n')
-        text_file.close()
+        if boot_duration is not None:
+            text_file = open(comb_dir + "boot_time.txt", "w")
+            for vm in vms:
+                text_file.write(boot_duration[vm['ip']] + ',' +
+                                vm['cpuset'] + '\n')
+            text_file.close()
+        if wall_duration is not None:
+            with open(comb_dir + "boot_wall_time.txt", "w") as text_file:
+                text_file.write(str(wall_duration) + '\n')
 
         return True
 
@@ -190,6 +230,9 @@ class VMBootMeasurement(vm5k_engine_para):
             ['covm-' + str(i) for i in range(comb['n_co_vms'] * comb['n_vm'])]
         # set the disk
         backing_file = '/home/lpouilloux/synced/images/benchs_vms.qcow2'
+        if comb['vms_network'] == 'static':
+            backing_file = backing_file.replace('benchs_vms',
+                                                'static-benchs_vms')
         real_file = comb['image_policy'] == 'one_per_vm'
         # set the CPU
         n_cpu = comb['n_cpu']
@@ -221,14 +264,22 @@ class VMBootMeasurement(vm5k_engine_para):
                          backing_file=backing_file,
                          real_file=real_file)
 
+        # in snapshot mode, xpvms disks are created when restoring them
+        if comb['boot_mode'] == 'snapshot':
+            vms_to_install = filter(lambda v: 'covm' in v['id'], vms)
+        else:
+            vms_to_install = vms
+        if len(vms_to_install) == 0:
+            return vms
+
         logger.info('Creating disks')
-        create = create_disks(vms).run()
+        create = create_disks(vms_to_install).run()
         if not create.ok:
             logger.error('Unable to create the VMS disks for %s ',
                          slugify(comb))
             exit()
         logger.info('Installing VMS')
-        install = install_vms(vms).run()
+        install = install_vms(vms_to_install).run()
         if not install.ok:
             logger.error('Unable to install the VMS for %s ',
                          slugify(comb))
@@ -301,9 +352,27 @@ class VMBootMeasurement(vm5k_engine_para):
         logger.info('Configure libvirt')
         setup.configure_libvirt()
         logger.info('Rebooting hosts')
-        reboot_hosts(setup.hosts)
+        reboot_hosts(setup.hosts, kexec=True)
         logger.info('Create backing file')
         setup._create_backing_file(disks=disks)
+        network = setup.network or {}
+        if not network.get('netmask') or not network.get('gateway') or \
+                not network.get('dns'):
+            logger.error('No static network in the resources, skipping '
+                         'the %s combinations', style.emph('static'))
+            for comb in self.sweeper.get_remaining():
+                if comb['vms_network'] == 'static':
+                    self.sweeper.skip(comb)
+            return
+        logger.info('Create backing file with static network')
+        setup.fact.get_remote('cp /tmp/benchs_vms.qcow2 '
+                              '/tmp/static-benchs_vms.qcow2',
+                              setup.hosts).run()
+        vms_network = [(mac, ip, setup.network['netmask'],
+                        setup.network['gateway'], setup.network['dns'])
+                       for ip, mac in setup.ip_mac]
+        static_network_seed(setup.hosts, '/tmp/static-benchs_vms.qcow2',
+                            vms_network).run()
 
 
 if __name__ == "__main__":
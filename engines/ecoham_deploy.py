@@ -35,12 +35,6 @@ class EcohamDeploy(vm5k_engine):
         setup._actions_hosts(mount_storage5k)
         logger.info('Mounting storage5k ... Done')
 
-    def _copy_packages(self, setup, filenames, dir_path=expanduser("~")):
-        logger.info('Copying packages sourcecode to hosts')
-        copy_files = setup.fact.get_fileput(setup.hosts, ['%s/%s' % (dir_path, filename) for filename in filenames]).run()
-        setup._actions_hosts(copy_files)
-        logger.info('Copying packages sourcecode to hosts ... Done')
-
     def _compile_ecoham(self, setup):
         logger.info('Compiling ECOHAM')
         cmd = '''
@@ -53,19 +47,15 @@ class EcohamDeploy(vm5k_engine):
         setup._actions_hosts(compile_ecoham)
         logger.info('Compiling ECOHAM ... Done')
 
-    def _compile_library(self, setup, params):
+    def _compile_library(self, setup, params, dir_path=expanduser("~")):
         logger.info('Compiling %s' % params['name'])
-        cmd = '''
-            (tar xf {zipfile}) &&
-            cd {dirname} &&
-            (./configure --prefix=/usr/local/) &&
-            make &&
-            make install
-        '''.format(**params)
+        cmd = '''./configure --prefix=/usr/local/ && make'''
         if params['name'] == 'netCDF-Fortran':
             cmd = '''export LD_LIBRARY_PATH=/usr/local/lib:${LD_LIBRARY_PATH} && ''' + cmd
-        compile_library = setup.fact.get_remote(cmd, setup.hosts).run()
-        setup._actions_hosts(compile_library)
+        self.install_artifact(setup, params['name'],
+                              '%s/%s' % (dir_path, params['zipfile']),
+                              params['dirname'], cmd,
+                              params.get('depends'))
         logger.info('Compiling %s ... Done' % params['name'])
 
     def setup_hosts(self):
@@ -85,11 +75,6 @@ class EcohamDeploy(vm5k_engine):
         setup.packages_management(other_packages='sysstat,gfortran,git', launch_disk_copy=False)
         logger.info('Finished installing packages')
         self._setup_storage5k(setup)
-        self._copy_packages(setup, ['zlib-1.2.8.tar.gz',
-            'hdf5-1.8.17.tar',
-            'netcdf-4.4.0.tar.gz',
-            'netcdf-fortran-4.4.4.tar.gz',
-            'mpich-3.2.tar.gz'])
         self._compile_library(setup,
             {
                 'name': 'zlib',
@@ -103,7 +88,8 @@ class EcohamDeploy(vm5k_engine):
                 'name': 'HDF5',
                 'url': 'http://www.hdfgroup.org/ftp/HDF5/current/src/hdf5-1.8.17.tar',
                 'zipfile': 'hdf5-1.8.17.tar',
-                'dirname': 'hdf5-1.8.17'
+                'dirname': 'hdf5-1.8.17',
+                'depends': ['zlib']
             })
 
         self._compile_library(setup,
@@ -111,7 +97,8 @@ class EcohamDeploy(vm5k_engine):
                 'name': 'netCDF',
                 'url': 'ftp://ftp.unidata.ucar.edu/pub/netcdf/netcdf-4.4.0.tar.gz',
                 'zipfile': 'netcdf-4.4.0.tar.gz',
-                'dirname': 'netcdf-4.4.0'
+                'dirname': 'netcdf-4.4.0',
+                'depends': ['zlib', 'HDF5']
             })
 
         self._compile_library(setup,
@@ -119,7 +106,8 @@ class EcohamDeploy(vm5k_engine):
                 'name': 'netCDF-Fortran',
                 'url': 'https://github.com/Unidata/netcdf-fortran/archive/v4.4.4.tar.gz',
                 'zipfile': 'netcdf-fortran-4.4.4.tar.gz',
-                'dirname': 'netcdf-fortran-4.4.4'
+                'dirname': 'netcdf-fortran-4.4.4',
+                'depends': ['netCDF']
             })
 
         self._compile_library(setup,
@@ -160,7 +148,7 @@ class EcohamDeploy(vm5k_engine):
             # threads = {}
 
             # Checking that the job is running and not in Error
-            while get_oar_job_info(self.oar_job_id, self.frontend)['state'] != 'Error' \
+            while self.is_job_alive()['state'] != 'Error' \
                     or len(threads.keys()) > 0:
                 job_is_dead = False
                 # while self.options.n_nodes > len(available_hosts):
@@ -171,7 +159,7 @@ class EcohamDeploy(vm5k_engine):
                 #             available_ip_mac.extend(tmp_threads[t]['ip_mac'])
                 #             del threads[t]
                 #     sleep(5)
-                if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error':
+                if self.is_job_alive()['state'] == 'Error':
                     job_is_dead = True
                     break
                 # if job_is_dead:
@@ -202,8 +190,8 @@ class EcohamDeploy(vm5k_engine):
                 # logger.debug('Threads: %s', len(threads))
                 # t.daemon = True
                 # t.start()
-            print 'info', get_oar_job_info(self.oar_job_id, self.frontend)
-            if get_oar_job_info(self.oar_job_id, self.frontend)['state'] == 'Error':
+            print 'info', self.is_job_alive()
+            if self.is_job_alive()['state'] == 'Error':
                 job_is_dead = True
 
             if job_is_dead:
@@ -2,8 +2,11 @@ from config import default_vm
 from deployment import vm5k_deployment
 from actions import define_vms, install_vms, create_disks, destroy_vms, \
     list_vm, start_vms, wait_vms_have_started, create_disks_all_hosts, \
-    show_vms, rm_qcow2_disks, distribute_vms, activate_vms
+    show_vms, rm_qcow2_disks, distribute_vms, activate_vms, \
+    start_vms_from_snapshot, static_network_seed, reserve_hugepages, \
+    configure_ksm, enable_net_queues
 from services import dnsmasq_server
 from utils import prettify, get_max_vms, get_vms_slot, print_step, \
     get_oargrid_job_vm5k_resources, get_oar_job_vm5k_resources, \
     get_CPU_RAM_FLOPS
+from topology import get_host_topology
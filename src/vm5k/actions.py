@@ -24,11 +24,13 @@ from execo import SshProcess, TaktukPut, logger, TaktukRemote, Process, \
 from execo.log import style
 from execo.time_utils import sleep
 from execo_g5k import get_host_site
+from execo_g5k.api_utils import get_host_cluster
 import tempfile
 from math import ceil
 from execo.exception import ActionsFailed
 from config import default_vm
 from utils import get_CPU_RAM_FLOPS, get_max_vms
+from topology import get_host_topology, _parse_cpu_list, _format_cpu_list
 from itertools import cycle
 from random import randint
 
@@ -46,13 +48,20 @@ def show_vms(vms):
 
 def define_vms(vms_id, template=None, ip_mac=None, tap=None, state=None,
                host=None, n_cpu=None, cpusets=None, mem=None, hdd=None,
-               backing_file=None, real_file=None):
+               backing_file=None, real_file=None, disk_cache=None,
+               disk_io=None, cluster_size=None, preallocation=None,
+               lazy_refcounts=None, hugepages=None, mem_lock=None,
+               numatune=None, net_queues=None, net_driver=None,
+               txqueuelen=None, mtu=None):
     """Create a list of virtual machines, where VM parameter is a dict
     similar to
     {'id': None, 'host': None, 'ip': None, 'mac': None,
     'mem': 512, 'n_cpu': 1, 'cpuset': 'auto',
     'hdd': 10, 'backing_file': '/tmp/vm-base.img',
-    'state': 'KO'}
+    'state': 'KO', 'disk_cache': 'none', 'disk_io': 'threads',
+    'cluster_size': 65536, 'preallocation': 'off', 'lazy_refcounts': False,
+    'hugepages': False, 'mem_lock': False, 'numatune': 'none',
+    'net_queues': 1, 'net_driver': 'default', 'txqueuelen': 0, 'mtu': 0}
 
     Can be generated from a template or using user defined parameters that
     can be a single element or a list of element
@@ -70,6 +79,38 @@ def define_vms(vms_id, template=None, ip_mac=None, tap=None, state=None,
     :param n_cpu: the number of virtual CPU of the VMs
 
     :param real_file: boolean to use a real file
+
+    :param disk_cache: the cache mode of the disk (none, writeback,
+      writethrough, directsync or unsafe)
+
+    :param disk_io: the io mode of the disk (native, threads or io_uring)
+
+    :param cluster_size: the cluster size of the qcow2 disk, in bytes
+
+    :param preallocation: the preallocation of the qcow2 disk (off,
+      metadata, falloc or full)
+
+    :param lazy_refcounts: boolean to delay the refcounts updates of the
+      qcow2 disk
+
+    :param hugepages: boolean to back the memory of the VMs with hugepages
+
+    :param mem_lock: boolean to lock the memory of the VMs in RAM
+
+    :param numatune: the NUMA memory mode of the VMs on the cells of their
+      cpuset (strict, preferred or interleave), none to disable it
+
+    :param net_queues: the number of queues of the virtio network
+      interface, auto for one queue per virtual CPU
+
+    :param net_driver: the backend of the virtio network interface (vhost
+      or qemu), default to let libvirt choose
+
+    :param txqueuelen: the txqueuelen of the tap device of the VMs on the
+      host, 0 to keep the default
+
+    :param mtu: the MTU of the network interface, 0 to use the one of the
+      bridge
     """
 
     n_vm = len(vms_id)
@@ -90,6 +131,30 @@ def define_vms(vms_id, template=None, ip_mac=None, tap=None, state=None,
             else [state] * n_vm if isinstance(state, str) else state
         host = [default_vm['host']] * n_vm if host is None \
             else [host] * n_vm if isinstance(host, str) else host
+        disk_cache = [default_vm['disk_cache']] * n_vm if disk_cache is None \
+            else [disk_cache] * n_vm if isinstance(disk_cache, str) else disk_cache
+        disk_io = [default_vm['disk_io']] * n_vm if disk_io is None \
+            else [disk_io] * n_vm if isinstance(disk_io, str) else disk_io
+        cluster_size = [default_vm['cluster_size']] * n_vm if cluster_size is None \
+            else [cluster_size] * n_vm if isinstance(cluster_size, int) else cluster_size
+        preallocation = [default_vm['preallocation']] * n_vm if preallocation is None \
+            else [preallocation] * n_vm if isinstance(preallocation, str) else preallocation
+        lazy_refcounts = [default_vm['lazy_refcounts']] * n_vm if lazy_refcounts is None \
+            else [lazy_refcounts] * n_vm if isinstance(lazy_refcounts, bool) else lazy_refcounts
+        hugepages = [default_vm['hugepages']] * n_vm if hugepages is None \
+            else [hugepages] * n_vm if isinstance(hugepages, bool) else hugepages
+        mem_lock = [default_vm['mem_lock']] * n_vm if mem_lock is None \
+            else [mem_lock] * n_vm if isinstance(mem_lock, bool) else mem_lock
+        numatune = [default_vm['numatune']] * n_vm if numatune is None \
+            else [numatune] * n_vm if isinstance(numatune, str) else numatune
+        net_queues = [default_vm['net_queues']] * n_vm if net_queues is None \
+            else [net_queues] * n_vm if isinstance(net_queues, (int, str)) else net_queues
+        net_driver = [default_vm['net_driver']] * n_vm if net_driver is None \
+            else [net_driver] * n_vm if isinstance(net_driver, str) else net_driver
+        txqueuelen = [default_vm['txqueuelen']] * n_vm if txqueuelen is None \
+            else [txqueuelen] * n_vm if isinstance(txqueuelen, int) else txqueuelen
+        mtu = [default_vm['mtu']] * n_vm if mtu is None \
+            else [mtu] * n_vm if isinstance(mtu, int) else mtu
 
     else:
         n_cpu = [default_vm['n_cpu']] * n_vm if 'n_cpu' not in template.attrib \
@@ -108,6 +173,30 @@ def define_vms(vms_id, template=None, ip_mac=None, tap=None, state=None,
             else [template.get('state')] * n_vm
         host = [default_vm['host']] * n_vm if 'host' not in template.attrib \
             else [template.get('host')] * n_vm
+        disk_cache = [default_vm['disk_cache']] * n_vm if 'disk_cache' not in template.attrib \
+            else [template.get('disk_cache')] * n_vm
+        disk_io = [default_vm['disk_io']] * n_vm if 'disk_io' not in template.attrib \
+            else [template.get('disk_io')] * n_vm
+        cluster_size = [default_vm['cluster_size']] * n_vm if 'cluster_size' not in template.attrib \
+            else [int(template.get('cluster_size'))] * n_vm
+        preallocation = [default_vm['preallocation']] * n_vm if 'preallocation' not in template.attrib \
+            else [template.get('preallocation')] * n_vm
+        lazy_refcounts = [default_vm['lazy_refcounts']] * n_vm if 'lazy_refcounts' not in template.attrib \
+            else [template.get('lazy_refcounts') in ['True', 'true', 'on']] * n_vm
+        hugepages = [default_vm['hugepages']] * n_vm if 'hugepages' not in template.attrib \
+            else [template.get('hugepages') in ['True', 'true', 'on']] * n_vm
+        mem_lock = [default_vm['mem_lock']] * n_vm if 'mem_lock' not in template.attrib \
+            else [template.get('mem_lock') in ['True', 'true', 'on']] * n_vm
+        numatune = [default_vm['numatune']] * n_vm if 'numatune' not in template.attrib \
+            else [template.get('numatune')] * n_vm
+        net_queues = [default_vm['net_queues']] * n_vm if 'net_queues' not in template.attrib \
+            else [template.get('net_queues')] * n_vm
+        net_driver = [default_vm['net_driver']] * n_vm if 'net_driver' not in template.attrib \
+            else [template.get('net_driver')] * n_vm
+        txqueuelen = [default_vm['txqueuelen']] * n_vm if 'txqueuelen' not in template.attrib \
+            else [int(template.get('txqueuelen'))] * n_vm
+        mtu = [default_vm['mtu']] * n_vm if 'mtu' not in template.attrib \
+            else [int(template.get('mtu'))] * n_vm
 
     ip_mac = [(None, None)] * n_vm if ip_mac is None else ip_mac
 
@@ -140,6 +229,12 @@ def define_vms(vms_id, template=None, ip_mac=None, tap=None, state=None,
             'cpuset': cpusets[i], 'hdd': hdd[i], 'host': host[i],
             'backing_file': backing_file[i], 'real_file': real_file[i],
             'state': state[i], 'tap': tap[i],
+            'disk_cache': disk_cache[i], 'disk_io': disk_io[i],
+            'cluster_size': cluster_size[i], 'preallocation': preallocation[i],
+            'lazy_refcounts': lazy_refcounts[i], 'hugepages': hugepages[i],
+            'mem_lock': mem_lock[i], 'numatune': numatune[i],
+            'net_queues': net_queues[i], 'net_driver': net_driver[i],
+            'txqueuelen': txqueuelen[i], 'mtu': mtu[i],
             'ip': ip_mac[i][0], 'mac': ip_mac[i][1]} for i in range(n_vm)]
 
     logger.debug('VM parameters have been defined:\n%s',
@@ -270,16 +365,82 @@ def destroy_vms(hosts, undefine=False):
             break
 
 
+def qcow2_options(vm, backing_file=False):
+    """Return the qemu-img options of the qcow2 disk of the VM, from its
+    cluster_size, preallocation and lazy_refcounts. The preallocation of
+    an overlay with a backing file is refused by qemu-img before 4.2, so
+    it requires a real_file."""
+    options = 'cluster_size=' + str(vm.get('cluster_size',
+                                           default_vm['cluster_size']))
+    preallocation = vm.get('preallocation', default_vm['preallocation'])
+    if preallocation != 'off':
+        if backing_file:
+            raise ValueError('%s: preallocation=%s requires a real_file' %
+                             (vm['id'], preallocation))
+        options += ',preallocation=' + preallocation
+    if vm.get('lazy_refcounts', default_vm['lazy_refcounts']):
+        options += ',compat=1.1,lazy_refcounts=on'
+    return options
+
+
+def get_net_queues(vm):
+    """Return the number of queues of the network interface of the VM,
+    its number of CPU if net_queues is auto"""
+    queues = vm.get('net_queues', default_vm['net_queues'])
+    return vm['n_cpu'] if queues == 'auto' else int(queues)
+
+
+def network_options(vm):
+    """Return the virt-install 1.x options of the network interface of the
+    VM, from its net_queues and net_driver. Its mtu is given by the libvirt
+    network of the host, as virt-install 1.x has no option for it."""
+    options = 'network=default,mac=' + vm['mac']
+    queues = get_net_queues(vm)
+    driver = vm.get('net_driver', default_vm['net_driver'])
+    if queues > 1 or driver != 'default':
+        options += ',model=virtio'
+    if driver != 'default':
+        options += ',driver_name=' + driver
+    if queues > 1:
+        options += ',driver_queues=' + str(queues)
+    return options
+
+
+def cmd_txqueuelen(vm):
+    """Return a command that sets the txqueuelen of the tap devices of a
+    running VM, as libvirt does not configure it"""
+    txqueuelen = vm.get('txqueuelen', default_vm['txqueuelen'])
+    if not txqueuelen:
+        return ''
+    return 'for tap in `virsh --connect qemu:///system domiflist ' + \
+        vm['id'] + ' | awk \'NR > 2 && NF {print $1}\'` ; ' + \
+        'do ip link set dev $tap txqueuelen ' + str(txqueuelen) + ' ; done ; '
+
+
+def enable_net_queues(vms, iface='eth0'):
+    """Return an action that enables in the running VMs the queues of
+    their multi-queue network interface, as the guest uses only one by
+    default"""
+    vms_cmds = {vm['ip']: 'ethtool -L ' + iface + ' combined ' +
+                str(get_net_queues(vm)) for vm in vms
+                if get_net_queues(vm) > 1}
+    logger.debug(pformat(vms_cmds))
+
+    return TaktukRemote('{{vms_cmds.values()}}', list(vms_cmds.keys()))
+
+
 def cmd_disk_real(vm, data_file_dir, backing_file_dir):
     """Return a command to create a new disk from the backing_file"""
     return 'qemu-img convert %s' % backing_file_dir + vm['backing_file'].split('/')[-1] + \
-        ' -O qcow2 %s' % data_file_dir + vm['id'] + '.qcow2 ;'
+        ' -O qcow2 -o ' + qcow2_options(vm) + ' %s' % data_file_dir + \
+        vm['id'] + '.qcow2 ;'
 
 
 def cmd_disk_qcow2(vm, data_file_dir, backing_file_dir):
     """Return a command to create a qcow2 file using the backing_file"""
     return 'qemu-img create -f qcow2 -o backing_file=%s' % backing_file_dir + \
-        vm['backing_file'].split('/')[-1] + ',backing_fmt=qcow2 %s' % data_file_dir + \
+        vm['backing_file'].split('/')[-1] + ',backing_fmt=qcow2,' + \
+        qcow2_options(vm, backing_file=True) + ' %s' % data_file_dir + \
         vm['id'] + '.qcow2 ' + str(vm['hdd']) + 'G ; '
 
 
@@ -302,7 +463,8 @@ def create_disks(vms, data_file_dir='/tmp/', backing_file_dir='/tmp/'):
     return TaktukRemote('{{hosts_cmds.values()}}', list(hosts_cmds.keys()))
 
 
-def create_disks_all_hosts(vms, hosts):
+def create_disks_all_hosts(vms, hosts, data_file_dir='/tmp/',
+                           backing_file_dir='/tmp/'):
     """Create a temporary file containing the vms disks creation commands
     upload it and run it on the hosts"""
 
@@ -310,9 +472,9 @@ def create_disks_all_hosts(vms, hosts):
     f = fdopen(fd, 'w')
     for vm in vms:
         if vm['real_file']:
-            vm_cmd = cmd_disk_real(vm)
+            vm_cmd = cmd_disk_real(vm, data_file_dir, backing_file_dir)
         else:
-            vm_cmd = cmd_disk_qcow2(vm)
+            vm_cmd = cmd_disk_qcow2(vm, data_file_dir, backing_file_dir)
         f.write('\n' + vm_cmd)
     f.close()
 
@@ -322,6 +484,62 @@ def create_disks_all_hosts(vms, hosts):
                               Local('rm ' + vms_disks)])
 
 
+static_ip_script = """#!/bin/sh
+# Configure the interface $1 from the vm5k network table, or using DHCP
+# if its mac address is not in the table
+mac=`cat /sys/class/net/$1/address`
+conf=`grep -i "^$mac " /etc/vm5k/network`
+if [ -z "$conf" ]; then
+    exec dhclient $1
+fi
+set -- $1 $conf
+ifconfig $1 $3 netmask $4 up
+route add default gw $5 $1
+echo "nameserver $6" > /etc/resolv.conf
+"""
+
+
+def static_network_seed(hosts, disk, vms_network):
+    """Return an action that writes in the disk image a table giving the ip,
+    netmask, gateway and dns of every VM mac address, with a script that
+    configures the guest interfaces from it instead of using DHCP.
+
+    :param hosts: the hosts where the disk image is located
+
+    :param disk: the path of the disk image on the hosts
+
+    :param vms_network: a list of tuple (mac, ip, netmask, gateway, dns)
+    """
+    fd, table = tempfile.mkstemp(dir='/tmp/', prefix='vms_network_')
+    f = fdopen(fd, 'w')
+    for vm_network in vms_network:
+        f.write(' '.join(vm_network) + '\n')
+    f.close()
+    fd, script = tempfile.mkstemp(dir='/tmp/', prefix='static_ip_')
+    f = fdopen(fd, 'w')
+    f.write(static_ip_script)
+    f.close()
+
+    table, script = table.split('/')[-1], script.split('/')[-1]
+    cmd = 'modprobe nbd max_part=16; ' + \
+        'qemu-nbd --connect=/dev/nbd0 ' + disk + \
+        ' ; sleep 3 ; partprobe /dev/nbd0 ; ' + \
+        'part=`fdisk -l /dev/nbd0 |grep dev|grep Linux| grep -v swap|cut -f 1 -d " "` ; ' + \
+        'mount $part /mnt ; mkdir -p /mnt/etc/vm5k ; ' + \
+        'mv ' + table + ' /mnt/etc/vm5k/network ; ' + \
+        'mv ' + script + ' /mnt/etc/vm5k/static-ip ; ' + \
+        'chmod +x /mnt/etc/vm5k/static-ip ; ' + \
+        'sed -i "s/^iface \\([a-z0-9]*\\) inet dhcp$/iface \\1 inet manual\\n' + \
+        '    up \\/etc\\/vm5k\\/static-ip \\1/" /mnt/etc/network/interfaces ; ' + \
+        'umount /mnt; qemu-nbd -d /dev/nbd0'
+    logger.detail(cmd)
+
+    return SequentialActions([TaktukPut(hosts, ['/tmp/' + table,
+                                                '/tmp/' + script]),
+                              TaktukRemote(cmd, hosts),
+                              Local('rm /tmp/' + table + ' /tmp/' + script)])
+
+
 def install_vms(vms, data_file_dir='/tmp/'):
     """ Return an action to install the VM on the hosts"""
     logger.detail(', '.join([vm['id'] for vm in sorted(vms)]))
@@ -329,11 +547,24 @@ def install_vms(vms, data_file_dir='/tmp/'):
     for vm in vms:
         cmd = 'virt-install -d --import --connect qemu:///system ' + \
             '--nographics --noautoconsole --noreboot --name=' + vm['id'] + ' '\
-            '--network network=default,mac=' + vm['mac'] + ' --ram=' + \
+            '--network ' + network_options(vm) + ' --ram=' + \
             str(vm['mem']) + ' --disk path=%s' % data_file_dir + vm['id'] + \
             '.qcow2,device=disk,bus=virtio,format=qcow2,size=' + \
-            str(vm['hdd']) + ',cache=none ' + \
+            str(vm['hdd']) + ',cache=' + \
+            vm.get('disk_cache', default_vm['disk_cache']) + ',io=' + \
+            vm.get('disk_io', default_vm['disk_io']) + ' ' + \
             '--vcpus=' + str(vm['n_cpu']) + ' --cpuset=' + vm['cpuset']
+        memorybacking = [option + '=on' for option, key in
+                         [('hugepages', 'hugepages'), ('locked', 'mem_lock')]
+                         if vm.get(key, default_vm[key])]
+        if memorybacking:
+            cmd += ' --memorybacking ' + ','.join(memorybacking)
+        numatune = vm.get('numatune', default_vm['numatune'])
+        if numatune != 'none':
+            # the nodeset is quoted for virt-install, as it contains commas
+            cmd += ' --numatune \'"' + \
+                _format_cpu_list(get_vm_numa_cells(vm)) + '"\',mode=' + \
+                numatune
         if vm['tap']:
             cmd += '--network tap,script=no,ifname=' + vm['tap']
         cmd += ' > /dev/null 2>&1 '
@@ -345,11 +576,93 @@ def install_vms(vms, data_file_dir='/tmp/'):
     return TaktukRemote('{{hosts_cmds.values()}}', list(hosts_cmds.keys()))
 
 
+def get_vm_cells(vm):
+    """Return the NUMA cells of the host of the VM that contain the CPU of
+    its cpuset, or all the cells if its cpuset is auto"""
+    cells = get_host_topology(get_host_cluster(vm['host']),
+                              need_cells=True).cells
+    if vm['cpuset'] == 'auto':
+        return sorted(cells)
+    cpus = set(_parse_cpu_list(vm['cpuset']))
+    return sorted(cell for cell, cell_cpus in cells.iteritems()
+                  if cpus & set(cell_cpus))
+
+
+def get_vm_numa_cells(vm):
+    """Return the NUMA cells where the memory of the VM is placed, the
+    first cell of its cpuset with the preferred numatune mode"""
+    cells = get_vm_cells(vm)
+    if vm.get('numatune', default_vm['numatune']) == 'preferred':
+        return cells[:1]
+    return cells
+
+
+def reserve_hugepages(vms, page_size=2048):
+    """Return an action that reserves on each NUMA cell of the hosts the
+    hugepages of the VMs backed by hugepages, and mounts hugetlbfs for
+    libvirt. The memory of a VM is split on the cells of its cpuset, or
+    reserved on the first one with the preferred numatune mode.
+
+    :param vms: a list of VMs dicts
+
+    :param page_size: the size of the hugepages, in KiB
+    """
+    pages = {}
+    for vm in vms:
+        if not vm.get('hugepages', default_vm['hugepages']):
+            continue
+        cells = get_vm_numa_cells(vm)
+        vm_pages = int(ceil(vm['mem'] * 1024. / page_size / len(cells)))
+        host_pages = pages.setdefault(vm['host'], {})
+        for cell in cells:
+            host_pages[cell] = host_pages.get(cell, 0) + vm_pages
+
+    hosts_cmds = {}
+    for host, cells_pages in pages.iteritems():
+        cmd = ''
+        for cell, n_pages in sorted(cells_pages.iteritems()):
+            nr_hugepages = '/sys/devices/system/node/node' + str(cell) + \
+                '/hugepages/hugepages-' + str(page_size) + 'kB/nr_hugepages'
+            cmd += '(echo ' + str(n_pages) + ' > ' + nr_hugepages + ' ; ' + \
+                '[ `cat ' + nr_hugepages + '` -ge ' + str(n_pages) + ' ]) && '
+        cmd += '(grep -q hugetlbfs /proc/mounts || (mkdir -p /dev/hugepages' + \
+            ' && mount -t hugetlbfs hugetlbfs /dev/hugepages && ' + \
+            'service libvirtd restart))'
+        hosts_cmds[host] = cmd
+    logger.debug(pformat(hosts_cmds))
+
+    return TaktukRemote('{{hosts_cmds.values()}}', list(hosts_cmds.keys()))
+
+
+def configure_ksm(hosts, policy='off'):
+    """Return an action that configures the Kernel Samepage Merging of the
+    hosts and stops ksmtuned
+
+    :param hosts: the hosts to configure
+
+    :param policy: off to unmerge all the pages and stop KSM, on to run
+      it with the kernel defaults, or aggressive to scan more pages more
+      often
+    """
+    ksm = {'off': {'run': 2},
+           'on': {'run': 1, 'pages_to_scan': 100, 'sleep_millisecs': 20},
+           'aggressive': {'run': 1, 'pages_to_scan': 1000,
+                          'sleep_millisecs': 10}}[policy]
+    cmd = 'service ksmtuned stop > /dev/null 2>&1 ; ' + \
+        ' ; '.join('echo ' + str(value) + ' > /sys/kernel/mm/ksm/' + key
+                   for key, value in sorted(ksm.iteritems(),
+                                            key=lambda item: item[0] == 'run'))
+    logger.detail(cmd)
+
+    return TaktukRemote(cmd, hosts)
+
+
 def start_vms(vms):
     """ Return an action to start the VMs on the hosts """
     hosts_cmds = {}
     for vm in vms:
-        cmd = 'virsh --connect qemu:///system start ' + vm['id'] + ' ; '
+        cmd = 'virsh --connect qemu:///system start ' + vm['id'] + ' ; ' + \
+            cmd_txqueuelen(vm)
         hosts_cmds[vm['host']] = cmd if not vm['host'] in hosts_cmds \
             else hosts_cmds[vm['host']] + cmd
 
@@ -357,22 +670,195 @@ def start_vms(vms):
     return TaktukRemote('{{hosts_cmds.values()}}', list(hosts_cmds.keys()))
 
 
-def activate_vms(vms, dest='lyon.grid5000.fr'):
-    """Connect locally on every host and on all VMS to ping a host
-    and update ARP tables"""
-    logger.info('Executing ping from virtual machines on hosts')
-    cmd = "VMS=`virsh list | grep -v State | grep -v -e '----' | awk '{print $2}'`; " + \
-        "for VM in $VMS; do " + \
-        " ssh $VM \"ping -c 3 " + dest + " \"; " + \
-        "done"
-    logger.debug('Launching ping probes to update ARP tables with %s', cmd)
-    activate = TaktukRemote(cmd, list(set([vm['host'] for vm in vms])))
+# Python script executed on the hosts to derive the saved state of a clone
+# from the state of the golden VM, by rewriting the domain XML stored in the
+# libvirt save header (name, uuid, disk) and copying the memory stream
+clone_state_script = '''import sys, struct, uuid
+from xml.etree.ElementTree import fromstring, tostring
+src, dst, name, disk = sys.argv[1:5]
+fin = open(src, 'rb')
+header = fin.read(92)
+fields = list(struct.unpack('=16s19I', header))
+data = fin.read(fields[2])
+cookie = data[fields[5]:] if fields[5] else ''
+dom = fromstring(data.split('\\0')[0])
+dom.find('name').text = name
+dom.find('uuid').text = str(uuid.uuid4())
+dom.find('devices/disk/source').set('file', disk)
+xml = tostring(dom) + '\\0'
+fields[2] = len(xml) + len(cookie)
+if fields[5]:
+    fields[5] = len(xml)
+fout = open(dst, 'wb')
+fout.write(struct.pack('=16s19I', *fields) + xml + cookie)
+while True:
+    chunk = fin.read(1 << 22)
+    if not chunk:
+        break
+    fout.write(chunk)
+fout.close()
+'''
+
+
+def _snapshot_profile(vm):
+    """Return the key of the VMs that can be restored from the same memory
+    snapshot, i.e. same host, backing file, memory and number of CPU"""
+    return (vm['host'], vm['backing_file'].split('/')[-1], vm['mem'],
+            vm['n_cpu'])
+
+
+def define_golden_vms(vms):
+    """Return a dict whose keys are the snapshot profiles of the VMs and
+    values a golden VM, that use the ip and mac of the first VM of the
+    profile to boot before being saved
+
+    :param vms: a list of VMs dicts
+    """
+    goldens = {}
+    for vm in vms:
+        profile = _snapshot_profile(vm)
+        if profile not in goldens:
+            golden = vm.copy()
+            golden.update({'id': 'golden-' + vm['id'], 'real_file': False,
+                           'tap': None, 'state': 'KO'})
+            goldens[profile] = golden
+    logger.debug('Golden VMs \n%s',
+                 "\n".join([golden['id'] + ": " + str(golden['host'])
+                            for golden in goldens.itervalues()]))
+    return goldens
+
+
+def save_golden_vms(goldens, data_file_dir='/tmp/', snapshot_dir='/tmp/'):
+    """Boot the golden VMs, detach their network interface and save their
+    memory and device state in snapshot_dir. The golden disks must not
+    be modified afterwards, as they are used as backing file by the clones.
+
+    :param goldens: the dict returned by define_golden_vms
+
+    :param snapshot_dir: the directory of the saved states on the hosts
+    """
+    golden_vms = goldens.values()
+    logger.info('Booting golden vms %s',
+                ', '.join([style.VM(vm['id']) for vm in golden_vms]))
+    create_disks(golden_vms, data_file_dir=data_file_dir).run()
+    install_vms(golden_vms, data_file_dir=data_file_dir).run()
+    start_vms(golden_vms).run()
+    if not wait_vms_have_started(golden_vms, restart=False):
+        return False
+
+    hosts_cmds = {}
+    for vm in golden_vms:
+        cmd = 'virsh --connect qemu:///system detach-interface ' + \
+            vm['id'] + ' network --mac ' + vm['mac'] + ' ; sleep 2 ; ' + \
+            'virsh --connect qemu:///system save ' + vm['id'] + ' ' + \
+            snapshot_dir + vm['id'] + '.state && ' + \
+            'virsh --connect qemu:///system undefine ' + vm['id'] + ' ; '
+        hosts_cmds[vm['host']] = cmd if not vm['host'] in hosts_cmds \
+            else hosts_cmds[vm['host']] + cmd
+    logger.debug(pformat(hosts_cmds))
+    save = TaktukRemote('{{hosts_cmds.values()}}',
+                        list(hosts_cmds.keys())).run()
+    if not save.ok:
+        logger.error('Unable to save the golden vms')
+    return save.ok
+
+
+def restore_vms(vms, goldens, data_file_dir='/tmp/', snapshot_dir='/tmp/'):
+    """Return an action that start the VMs by restoring the state of their
+    golden VM onto a qcow2 overlay of the golden disk and attaching a new
+    network interface with the VM mac. The guest must bring up its
+    hotplugged interface with DHCP (allow-hotplug) to get the VM ip.
+
+    :param vms: a list of VMs dicts, that must not be defined on the hosts
+
+    :param goldens: the dict of saved golden VMs
+    """
+    fd, script = tempfile.mkstemp(dir='/tmp/', prefix='clone_state_')
+    f = fdopen(fd, 'w')
+    f.write(clone_state_script)
+    f.close()
+    script_name = script.split('/')[-1]
+
+    hosts_cmds = {}
+    for vm in vms:
+        golden = goldens[_snapshot_profile(vm)]
+        disk = data_file_dir + vm['id'] + '.qcow2'
+        state = snapshot_dir + vm['id'] + '.state'
+        steps = ['qemu-img create -f qcow2 -o backing_file=' +
+                 data_file_dir + golden['id'] + '.qcow2,backing_fmt=qcow2 ' +
+                 disk,
+                 'python ' + script_name + ' ' + snapshot_dir + golden['id'] +
+                 '.state ' + state + ' ' + vm['id'] + ' ' + disk,
+                 '(virsh --connect qemu:///system restore ' + state + ' ; ' +
+                 'status=$? ; rm -f ' + state + ' ; exit $status)',
+                 'virsh --connect qemu:///system attach-interface ' +
+                 vm['id'] + ' network default --mac ' + vm['mac'] +
+                 ' --model virtio']
+        if cmd_txqueuelen(vm):
+            steps.append(cmd_txqueuelen(vm).rstrip(' ;'))
+        # the other VMs of the host are restored if one fails
+        cmd = '(' + ' && '.join(steps) + ') || failed=1 ; '
+        hosts_cmds[vm['host']] = cmd if not vm['host'] in hosts_cmds \
+            else hosts_cmds[vm['host']] + cmd
+    hosts_cmds = {host: 'failed= ; ' + cmds + 'rm -f ' + script_name +
+                  ' ; [ -z "$failed" ]'
+                  for host, cmds in hosts_cmds.iteritems()}
+    logger.debug(pformat(hosts_cmds))
+    hosts = list(hosts_cmds.keys())
+
+    return SequentialActions([TaktukPut(hosts, [script]),
+                              TaktukRemote('{{hosts_cmds.values()}}', hosts),
+                              Local('rm ' + script)])
+
+
+def start_vms_from_snapshot(vms, data_file_dir='/tmp/', snapshot_dir='/tmp/'):
+    """Boot a golden VM once per host and VM profile, save it and start all
+    the VMs as clones of the saved state. Return True if all VMs have
+    started.
+
+    :param vms: a list of VMs dicts, which disks are created by this function
+    """
+    goldens = define_golden_vms(vms)
+    if not save_golden_vms(goldens, data_file_dir, snapshot_dir):
+        return False
+    logger.info('Restoring %s vms from %s snapshots', len(vms), len(goldens))
+    restore_vms(vms, goldens, data_file_dir, snapshot_dir).run()
+    return wait_vms_have_started(vms, restart=False)
+
+
+def activate_vms(vms, dest='lyon.grid5000.fr', bridge='br0',
+                 max_parallel=32):
+    """Update the ARP tables for the VMs whose state is KO, by connecting
+    on them to ping a host, so that the switches learn their mac. An ARP
+    request from the bridge of their host first checks that they are up,
+    to avoid waiting for the ssh timeout of the VMs that are down. The VMs
+    of a host are activated in parallel, max_parallel at a time. Return
+    True if all the VMs have been activated."""
+    vms = [vm for vm in vms if vm['state'] == 'KO']
+    if len(vms) == 0:
+        return True
+    logger.info('Activating %s VMs from their hosts', len(vms))
+    hosts_ips = {}
+    for vm in vms:
+        hosts_ips.setdefault(vm['host'], []).append(vm['ip'])
+    hosts = list(hosts_ips.keys())
+    vms_ips = [' '.join(hosts_ips[host]) for host in hosts]
+    cmd = 'echo {{vms_ips}} | xargs -n 1 -P ' + str(max_parallel) + \
+        ' sh -c \'(arping -q -c 1 -w 1 -I ' + bridge + ' $0 && ' + \
+        'ssh -o ConnectTimeout=2 $0 "ping -c 1 -W 1 ' + dest + '") ' + \
+        '> /dev/null 2>&1 || (echo $0 ; exit 1)\''
+    logger.debug('Launching ARP probes with %s', cmd)
+    activate = TaktukRemote(cmd, hosts)
     for p in activate.processes:
         p.ignore_exit_code = p.nolog_exit_code = True
         if logger.getEffectiveLevel() <= 10:
             p.stdout_handlers.append(sys.stdout)
     activate.run()
-    return activate.ok
+    failed = [ip for p in activate.processes if p.exit_code != 0
+              for ip in p.stdout.split()]
+    if len(failed) > 0:
+        logger.warning('Unable to activate %s', ', '.join(failed))
+    return all(p.exit_code == 0 for p in activate.processes)
 
 
 def wait_vms_have_started(vms, restart=True):
@@ -1,9 +1,23 @@
+from os import path
 from execo import configuration
 
 default_vm = {'id': None, 'host': None, 'ip': None, 'mac': None,
     'mem': 512, 'n_cpu': 1, 'cpuset': 'auto',
     'hdd': 10, 'backing_file': '/grid5000/images/KVM/wheezy-x64-base.qcow2',
-    'real_file': False, 'state': 'KO'}
+    'real_file': False, 'state': 'KO',
+    'disk_cache': 'none', 'disk_io': 'threads', 'cluster_size': 65536,
+    'preallocation': 'off', 'lazy_refcounts': False,
+    'hugepages': False, 'mem_lock': False, 'numatune': 'none',
+    'net_queues': 1, 'net_driver': 'default', 'txqueuelen': 0, 'mtu': 0}
+
+# directory where the CPU topology of the clusters is cached
+topology_dir = path.expanduser('~/.vm5k/topology')
+# directory where the packages bundles of the hosts are stored
+bundle_dir = path.expanduser('~/.vm5k/bundles')
+# directory where the binaries built by the engines are stored
+artifact_dir = path.expanduser('~/.vm5k/artifacts')
+# directory of the hosts where the VMs disks are created in memory
+ram_disks_dir = '/vm5k-ram'
 
 configuration['color_styles']['OK'] = 'green',  'bold'
 configuration['color_styles']['KO'] = 'red', 'bold'
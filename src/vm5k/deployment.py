@@ -16,7 +16,10 @@
 # You should have received a copy of the GNU General Public License
 # along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
 import sys
-from os import fdopen
+from os import fdopen, path, makedirs
+from hashlib import md5
+from math import ceil, log
+from multiprocessing.pool import ThreadPool
 from xml.etree.ElementTree import Element, SubElement, parse
 from time import localtime, strftime
 from tempfile import mkstemp
@@ -29,15 +32,23 @@ from execo_g5k import deploy, Deployment
 from execo_g5k.api_utils import get_host_cluster, \
     get_cluster_site, get_host_site, canonical_host_name, get_g5k_hosts
 from execo_g5k.utils import get_kavlan_host_name, hosts_list
-from vm5k.config import default_vm
+from vm5k.config import default_vm, bundle_dir, ram_disks_dir
 from vm5k.actions import create_disks, install_vms, start_vms, \
     wait_vms_have_started, destroy_vms, create_disks_all_hosts, distribute_vms,\
-    activate_vms
-from vm5k.utils import prettify, print_step, get_fastest_host, get_CPU_RAM_FLOPS
+    activate_vms, static_network_seed, reserve_hugepages
+from vm5k.utils import prettify, print_step, get_fastest_host, get_CPU_RAM_FLOPS, \
+    wait_hosts_up
 from vm5k.services import dnsmasq_server, setup_aptcacher_server, configure_apt_proxy
+from vm5k.services.dnsmasq import get_server_ip
+from vm5k.images import image_broadcast, image_pull, image_delta
 
 default_connection_params['user'] = 'root'
 
+base_packages = 'uuid-runtime bash-completion taktuk locate htop ' + \
+    'init-system-helpers netcat-traditional iputils-arping'
+libvirt_packages = 'libvirt-bin virtinst python2.7 python-pycurl ' + \
+    'python-libxml2 qemu-kvm nmap libgmp10'
+
 class vm5k_deployment():
     """ Base class to control a deployment of hosts and virtual machines on
     Grid'5000. It helps to  deploy a wheezy-x64-base environment,
@@ -51,7 +62,8 @@ class vm5k_deployment():
     def __init__(self, infile=None, resources=None, hosts=None,
                  ip_mac=None, vlan=None,
                  env_name=None, env_file=None, vms=None,
-                 distribution=None, outdir=None):
+                 distribution=None, outdir=None, vms_network='dhcp',
+                 image_transfer='put', image_compression=None):
         """:param infile: an XML file that describe the topology of the
         deployment
 
@@ -69,6 +81,21 @@ class vm5k_deployment():
         (``round-robin`` , ``concentrated``, ``random``)
 
         :params outdir: directory to store the deployment files
+
+        :params vms_network: how the virtual machines get their network
+        configuration, ``dhcp`` or ``static`` to write it in the backing
+        files before their boot
+
+        :params image_transfer: how the backing files are copied on the
+        hosts, ``put`` with the file put tool of the action factory, the
+        copies that differ being updated with a delta (see
+        :class:`vm5k.images.image_delta`), or ``broadcast`` with a checked pipeline between the hosts
+        (see :class:`vm5k.images.image_broadcast`), ``sparse`` to
+        broadcast only their data extents, or ``http`` to make the hosts
+        download them from a HTTP server of the frontend
+
+        :params image_compression: the gzip level used to compress the
+        backing files during a broadcast, None to disable compression
         """
         # set a factory for the deployment that use taktuk and chainput
         self.fact = ActionFactory(remote_tool=TAKTUK,
@@ -76,6 +103,10 @@ class vm5k_deployment():
                                   fileget_tool=TAKTUK)
         self.kavlan = None if not vlan else vlan
         self.kavlan_site = None
+        self.network = None
+        self.vms_network = vms_network
+        self.image_transfer = image_transfer
+        self.image_compression = image_compression
         if env_name is not None:
             self.env_file = None
             if ':' not in env_name:
@@ -98,6 +129,8 @@ class vm5k_deployment():
             self.outdir = 'vm5k_' + strftime("%Y%m%d_%H%M%S_%z")
 
         self.copy_actions = None
+        self.delta_actions = None
+        self.baked = False
 
         self.state = Element('vm5k')
         self._define_elements(infile, resources, hosts, vms, ip_mac,
@@ -141,41 +174,163 @@ class vm5k_deployment():
         self._launch_kadeploy(max_tries, check_deploy)
         if conf_ssh:
             self._configure_ssh()
+        self._check_baked_hosts()
 
     def packages_management(self, upgrade=True, other_packages=None,
-                            launch_disk_copy=True, apt_cacher=False):
+                            launch_disk_copy=True, apt_cacher=False,
+                            bundle=False):
         """Configure APT to use testing repository,
         perform upgrade and install required packages. Finally start
-        kvm module"""
+        kvm module.
+
+        With apt_cacher, an apt-cacher-ng server is installed on one host
+        by site, that downloads all the packages before the other hosts
+        of the site install them through it.
+
+        With bundle, the packages are downloaded once in an archive that
+        is broadcasted to the hosts and installed with dpkg.
+
+        Nothing is installed if the hosts have been deployed from an
+        environment created with bake_environment."""
+        if self.baked:
+            logger.info('Hosts have been deployed with a baked environment,' +
+                        ' skipping packages installation')
+            if launch_disk_copy:
+                self._start_disk_copy()
+            self.fact.get_remote(
+                'modprobe kvm; modprobe kvm-intel; modprobe kvm-amd ; ' + \
+                'chown root:kvm /dev/kvm ;', self.hosts).run()
+            return
         self._configure_apt()
-        if upgrade:
-            self._upgrade_hosts()
-        self._install_packages(other_packages=other_packages,
-                               launch_disk_copy=launch_disk_copy)
         if apt_cacher:
-            setup_aptcacher_server(self.hosts)
+            self._configure_apt_caches(upgrade, other_packages)
+        if bundle:
+            self._install_packages_bundle(upgrade, other_packages)
+            if launch_disk_copy:
+                self._start_disk_copy()
+        else:
+            self._update_apt()
+            if upgrade:
+                self._upgrade_hosts()
+            self._install_packages(other_packages=other_packages,
+                                   launch_disk_copy=launch_disk_copy,
+                                   update=False)
         # Post configuration to load KVM
         self.fact.get_remote(
             'modprobe kvm; modprobe kvm-intel; modprobe kvm-amd ; ' + \
             'chown root:kvm /dev/kvm ;', self.hosts).run()
 
-    def configure_service_node(self):
+    def bake_environment(self, name, host=None, image_dir=None):
+        """Capture a configured host as a Kadeploy environment and register
+        it, so that the next deployments with env_name=name do not have to
+        install the packages. It must be done before configure_service_node
+        that modify the DNS configuration of the hosts.
+
+        :param name: the name of the new environment
+
+        :param host: the host to capture, default to the first host
+
+        :param image_dir: the directory of the frontend where the image and
+          its description are written, default to ~/.vm5k/images
+
+        Return the path of the environment description
+        """
+        host = host if host else self.hosts[0]
+        image_dir = image_dir if image_dir else \
+            path.expanduser('~/.vm5k/images')
+        if not path.exists(image_dir):
+            makedirs(image_dir)
+        image = path.join(image_dir, name + '.tgz')
+        env_file = path.join(image_dir, name + '.env')
+
+        logger.info('Baking %s from %s', style.emph(name),
+                    style.host(host.split('.')[0]))
+        # the APT proxy of the apt caches only exists during this deployment
+        proxy = '/etc/apt/apt.conf.d/proxy-guess'
+        cmd = 'mkdir -p /etc/vm5k ; apt-get clean ; ' + \
+            'rm -f /etc/udev/rules.d/70-persistent-net.rules ; ' + \
+            '[ ! -f ' + proxy + ' ] || mv ' + proxy + ' /tmp/vm5k-proxy ; ' + \
+            'dpkg-query -W | md5sum | cut -f 1 -d " " > /etc/vm5k/fingerprint'
+        SshProcess(cmd, host).run()
+        capture = Process('ssh root@' + host + ' tgz-g5k > ' + image,
+                          shell=True).run()
+        SshProcess('[ ! -f /tmp/vm5k-proxy ] || mv /tmp/vm5k-proxy ' + proxy,
+                   host).run()
+        if not capture.ok:
+            logger.error('Unable to capture the image of %s', host)
+            return None
+
+        if self.env_file:
+            with open(self.env_file) as f:
+                base_desc = f.read()
+        else:
+            base_desc = Process('kaenv3 -p ' + self.env_name +
+                                (' -u ' + self.env_user if self.env_user
+                                 else '')).run().stdout
+        desc = []
+        in_image = False
+        for line in base_desc.split('\n'):
+            if line.startswith('name:'):
+                line = 'name: ' + name
+            elif line.startswith('description:'):
+                line = 'description: vm5k hosts baked from ' + \
+                    str(self.env_name or self.env_file)
+            elif line.startswith('visibility:'):
+                line = 'visibility: private'
+            elif line.startswith('tarball:'):
+                line = 'tarball: ' + image + '|tgz'
+            elif in_image and line.strip().startswith('file:'):
+                line = line[:line.index('file:')] + 'file: ' + image
+            if not line.startswith(' '):
+                in_image = line.startswith('image:')
+            desc.append(line)
+        with open(env_file, 'w') as f:
+            f.write('\n'.join(desc))
+        register = Process('kaenv3 -a ' + env_file).run()
+        if not register.ok:
+            logger.error('Unable to register %s', env_file)
+            return None
+        logger.info('Environment %s registered, described in %s',
+                    style.emph(name), env_file)
+        return env_file
+
+    def configure_service_node(self, shards='site'):
         """Setup automatically a DNS server to access virtual machines by id
-        and also install a DHCP server if kavlan is used"""
-        if self.kavlan:
+        and also install a DHCP server if kavlan is used.
+
+        :param shards: ``site`` to have a service node by site, an integer
+          N to have a service node for every N hosts of a site, or None to
+          have a single service node. Each service node is the DNS of its
+          hosts and the DHCP of their VMs, and resolves all the VMs.
+        """
+        if self.kavlan and self.vms_network == 'dhcp':
             service = 'DNS/DHCP'
             dhcp = True
         else:
             service = 'DNS'
             dhcp = False
 
-        service_node = get_fastest_host(self.hosts)
-        logger.info('Setting up %s on %s', style.emph(service),
-                    style.host(service_node.split('.')[0]))
-        clients = list(self.hosts)
-        clients.remove(service_node)
-
-        dnsmasq_server(service_node, clients, self.vms, dhcp)
+        self.service_nodes = {}
+        for shard_hosts in self._get_shards(shards):
+            service_node = get_fastest_host(shard_hosts)
+            logger.info('Setting up %s on %s for %s hosts', style.emph(service),
+                        style.host(service_node.split('.')[0]),
+                        len(shard_hosts))
+            self.service_nodes[service_node] = shard_hosts
+
+        def _setup_shard(service_node):
+            shard_hosts = self.service_nodes[service_node]
+            clients = [host for host in shard_hosts if host != service_node]
+            vms = [vm for vm in self.vms if vm['host'] in shard_hosts]
+            dns_vms = [vm for vm in self.vms if vm['host'] not in shard_hosts]
+            dnsmasq_server(service_node, clients, vms,
+                           dhcp and len(vms) > 0, dns_vms)
+
+        pool = ThreadPool(len(self.service_nodes))
+        try:
+            pool.map(_setup_shard, self.service_nodes.keys())
+        finally:
+            pool.close()
 
     def configure_libvirt(self, bridge='br0', libvirt_conf=None):
         """Enable a bridge if needed on the remote hosts, configure libvirt
@@ -183,6 +338,7 @@ class vm5k_deployment():
         """
         print 'Start configuring libvirt'
         self._enable_bridge()
+        self._tune_hosts_network(bridge)
         self._libvirt_check_service()
         self._libvirt_uniquify()
         self._libvirt_bridged_network(bridge)
@@ -190,23 +346,43 @@ class vm5k_deployment():
         self.fact.get_remote('service libvirtd restart', self.hosts).run()
 
     def deploy_vms(self, clean_disks=False, disk_location='one',
-                   apt_cacher=False):
+                   apt_cacher=False, disk_placement='disk'):
         """Destroy the existing VMS, create the virtual disks, install the vms
-        start them and wait until they have rebooted"""
+        start them and wait until they have rebooted
+
+        :param disk_placement: where the backing files and the disks of
+          the VMs are created, ``disk`` for /tmp, ``tmpfs`` for a tmpfs
+          of the hosts, or ``tmpfs_huge`` for a tmpfs backed by
+          transparent hugepages. The disk is used if the RAM of a host
+          is insufficient.
+        """
         logger.info('Destroying existing virtual machines')
         destroy_vms(self.hosts, undefine=True)
         if clean_disks:
             self._remove_existing_disks()
+        disks_dir = self._get_disks_dir(disk_placement)
+        if disks_dir == ram_disks_dir:
+            self._set_tmpfs_disks_options()
         logger.info('Creating the virtual disks ')
-        self._create_backing_file()
+        self._create_backing_file(disks_dir=disks_dir)
         if disk_location == 'one':
             logger.info('Create disk on each nodes')
-            create_disks(self.vms).run()
+            create_disks(self.vms, disks_dir + '/', disks_dir + '/').run()
         elif disk_location == 'all':
             logger.info('Create all disks on all nodes')
-            create_disks_all_hosts(self.vms, self.hosts).run()
+            create_disks_all_hosts(self.vms, self.hosts, disks_dir + '/',
+                                   disks_dir + '/').run()
+        if any(vm['hugepages'] for vm in self.vms):
+            logger.info('Reserving the hugepages of the virtual machines')
+            reserve = reserve_hugepages(self.vms).run()
+            if not reserve.ok:
+                logger.error('Unable to reserve the hugepages on %s',
+                             hosts_list([p.host.address
+                                         for p in reserve.processes
+                                         if not p.ok]))
+                exit()
         logger.info('Installing the virtual machines')
-        install_vms(self.vms).run()
+        install_vms(self.vms, disks_dir + '/').run()
         logger.info('Starting the virtual machines')
         self.boot_time = Timer()
         start_vms(self.vms).run()
@@ -215,7 +391,7 @@ class vm5k_deployment():
         activate_vms(self.vms)
         self._update_vms_xml()
         if apt_cacher:
-            configure_apt_proxy(self.vms)
+            configure_apt_proxy(self.vms, getattr(self, 'apt_caches', None))
 
     def get_state(self, name=None, output=True, mode='compact', plot=False):
         """ """
@@ -274,6 +450,26 @@ class vm5k_deployment():
         self._update_hosts_state(deployed_hosts, undeployed_hosts)
         return deployed_hosts, undeployed_hosts
 
+    def _check_baked_hosts(self):
+        """Set self.baked to True if all hosts have been deployed with a
+        baked environment whose packages have not changed"""
+        cmd = 'test -f /etc/vm5k/fingerprint && ' + \
+            '[ "`dpkg-query -W | md5sum | cut -f 1 -d \' \'`" = ' + \
+            '"`cat /etc/vm5k/fingerprint`" ]'
+        check = self.fact.get_remote(cmd, self.hosts)
+        for p in check.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        check.run()
+        baked = [p.host.address for p in check.processes
+                 if p.exit_code == 0]
+        self.baked = len(baked) == len(self.hosts)
+        if len(baked) > 0 and not self.baked:
+            logger.warning('Fingerprint of the baked environment does ' +
+                           'not match on %s',
+                           hosts_list([p.host.address
+                                       for p in check.processes
+                                       if p.exit_code != 0]))
+
     def _configure_ssh(self):
         if self.fact.remote_tool == 2:
             # Configuring SSH with precopy of id_rsa and id_rsa.pub keys on all
@@ -292,8 +488,25 @@ class vm5k_deployment():
     def _start_disk_copy(self, disks=None, backing_file_dir='/tmp'):
         """ """
         disks_copy = []
+        disks_delta = []
         if not disks:
             disks = self.backing_files
+        if self.image_transfer in ['broadcast', 'sparse']:
+            logger.info('Broadcasting %s', ', '.join([style.emph(bf)
+                                                      for bf in disks]))
+            self.copy_actions = image_broadcast(
+                disks, self.hosts, backing_file_dir,
+                sparse=self.image_transfer == 'sparse',
+                compression=self.image_compression)
+            self.copy_actions.start()
+            return
+        if self.image_transfer == 'http':
+            logger.info('Serving %s', ', '.join([style.emph(bf)
+                                                 for bf in disks]))
+            self.copy_actions = image_pull(disks, self.hosts,
+                                           backing_file_dir)
+            self.copy_actions.start()
+            return
         for bf in disks:
             logger.info('Treating ' + style.emph(bf))
             logger.debug("Checking frontend disk vs host disk")
@@ -304,29 +517,48 @@ class vm5k_deployment():
                 'then md5sum  -b ' + raw_disk + '; fi'
             h_disk = self.fact.get_remote(cmd, self.hosts).run()
             disk_ok = True
+            disk_present = False
             for p in h_disk.processes:
-
+                if p.stdout.strip():
+                    disk_present = True
                 if p.stdout.split(' ')[0] != disk_hash:
                     disk_ok = False
-                    break
             if disk_ok:
                 logger.info("Disk " + style.emph(bf) +
                             " is already present, skipping copy")
+            elif disk_present:
+                logger.info("Disk " + style.emph(bf) +
+                            " has changed, sending the differences")
+                disks_delta.append(bf)
             else:
                 disks_copy.append(self.fact.get_fileput(self.hosts, [bf],
                                                         remote_location="%s" % backing_file_dir))
+        if len(disks_delta) > 0:
+            self.delta_actions = image_delta(disks_delta, self.hosts,
+                                             backing_file_dir)
+            self.delta_actions.start()
         if len(disks_copy) > 0:
             self.copy_actions = ParallelActions(disks_copy).start()
         else:
             self.copy_actions = Remote('ls', self.hosts[0]).run()
 
-    def _create_backing_file(self, disks=None, backing_file_dir='/tmp'):
-        """ """
+    def _create_backing_file(self, disks=None, backing_file_dir='/tmp',
+                             disks_dir=None):
+        """Create the backing files of the VMs in disks_dir, by default
+        backing_file_dir, from their copy in backing_file_dir"""
         if not self.copy_actions:
             self._start_disk_copy(disks)
         if not self.copy_actions.ended:
             logger.info("Waiting for the end of the disks copy")
             self.copy_actions.wait()
+        if isinstance(self.copy_actions, image_broadcast) and \
+                not self.copy_actions.ok:
+            self._update_hosts_state([], self.copy_actions.failed_hosts)
+        if self.delta_actions:
+            self.delta_actions.wait()
+            if not self.delta_actions.ok:
+                self._update_hosts_state([],
+                                         self.delta_actions.failed_hosts)
         if isinstance(self.copy_actions, ParallelActions):
             mv_actions = []
             for act in self.copy_actions.actions:
@@ -341,7 +573,8 @@ class vm5k_deployment():
             disks = self.backing_files
         for bf in disks:
             raw_disk = '%s/orig_' % backing_file_dir + bf.split('/')[-1]
-            to_disk = '%s/' % backing_file_dir + bf.split('/')[-1]
+            to_disk = '%s/' % (disks_dir or backing_file_dir) + \
+                bf.split('/')[-1]
             self.fact.get_remote('cp ' + raw_disk + ' ' + to_disk, self.hosts).run()
             logger.info('Copying ssh key on ' + to_disk + ' ...')
             cmd = 'modprobe nbd max_part=16; ' + \
@@ -355,14 +588,87 @@ class vm5k_deployment():
             logger.detail(cmd)
             copy_on_vm_base = self.fact.get_remote(cmd, self.hosts).run()
             self._actions_hosts(copy_on_vm_base)
+            if self.vms_network == 'static':
+                vms_network = self._get_vms_network()
+                logger.info('Writing the network of %s VMs on %s ...',
+                            len(vms_network), to_disk)
+                static_network_seed(self.hosts, to_disk, vms_network).run()
+
+    def _get_disks_dir(self, disk_placement, overlay_size=1024):
+        """Return the directory of the hosts where the backing files and
+        the disks of the VMs are created. For a tmpfs placement, a tmpfs
+        is mounted on ram_disks_dir if the RAM of all the hosts, given by
+        get_CPU_RAM_FLOPS, can hold the memory of their VMs and their
+        disks, counting overlay_size MB for a qcow2 overlay."""
+        if disk_placement not in ['tmpfs', 'tmpfs_huge']:
+            return '/tmp'
+        backing_size = sum(path.getsize(bf) for bf in self.backing_files
+                           if path.exists(bf)) / 10 ** 6
+        disks_size = {host: backing_size for host in self.hosts}
+        vms_mem = {host: 0 for host in self.hosts}
+        for vm in self.vms:
+            if vm['real_file']:
+                disks_size[vm['host']] += backing_size
+            elif vm.get('preallocation') == 'full':
+                disks_size[vm['host']] += vm['hdd'] * 2 ** 30 / 10 ** 6
+            else:
+                disks_size[vm['host']] += overlay_size
+            vms_mem[vm['host']] += vm['mem']
+        hosts_attr = get_CPU_RAM_FLOPS(self.hosts)
+        # keep a tenth of the RAM for the hosts
+        short_hosts = [host for host in self.hosts
+                       if disks_size[host] + vms_mem[host] >
+                       hosts_attr[host]['RAM'] * 0.9]
+        if len(short_hosts) > 0:
+            logger.warning('Not enough RAM to place the disks in memory '
+                           'on %s, using the disk', hosts_list(short_hosts))
+            return '/tmp'
+
+        options = ',huge=always' if disk_placement == 'tmpfs_huge' else ''
+        hosts_cmds = {host: 'mkdir -p ' + ram_disks_dir + ' ; umount ' +
+                      ram_disks_dir + ' 2>/dev/null ; mount -t tmpfs -o ' +
+                      'size=' + str(int(ceil(disks_size[host]))) + 'M' +
+                      options + ' tmpfs ' + ram_disks_dir
+                      for host in self.hosts}
+        logger.debug(hosts_cmds)
+        mount = self.fact.get_remote('{{hosts_cmds.values()}}',
+                                     list(hosts_cmds.keys())).run()
+        if not mount.ok:
+            logger.warning('Unable to mount a %s on %s, using the disk',
+                           disk_placement, hosts_list(
+                               [p.host.address for p in mount.processes
+                                if not p.ok]))
+            self.fact.get_remote('umount ' + ram_disks_dir + ' 2>/dev/null',
+                                 self.hosts).run()
+            return '/tmp'
+        logger.info('The disks of the VMs are placed in a %s on %s',
+                    disk_placement, style.emph(ram_disks_dir))
+        return ram_disks_dir
+
+    def _set_tmpfs_disks_options(self):
+        """Use the writeback cache and the threads io for the disks placed
+        in a tmpfs, as O_DIRECT is not supported by tmpfs before Linux 6.6"""
+        for vm in self.vms:
+            if vm['disk_cache'] in ['none', 'directsync'] or \
+                    vm['disk_io'] == 'native':
+                if vm['disk_cache'] in ['none', 'directsync']:
+                    vm['disk_cache'] = 'writeback'
+                vm['disk_io'] = 'threads'
+                logger.warning('%s: using cache=%s,io=threads for its disk '
+                               'in a tmpfs', style.vm(vm['id']),
+                               vm['disk_cache'])
 
     def _remove_existing_disks(self, hosts=None):
-        """Remove all img and qcow2 file from /tmp directory """
+        """Remove all img and qcow2 file from /tmp directory and from the
+        tmpfs of the disks, and unmount it"""
         logger.info('Removing existing disks')
         if hosts is None:
             hosts = self.hosts
-        remove = self.fact.get_remote('rm -f /tmp/*.img; rm -f /tmp/*.qcow2',
-                                      self.hosts).run()
+        remove = self.fact.get_remote('rm -f /tmp/*.img; rm -f /tmp/*.qcow2; '
+                                      'rm -f ' + ram_disks_dir + '/*.img ' +
+                                      ram_disks_dir + '/*.qcow2; umount ' +
+                                      ram_disks_dir + ' 2>/dev/null; true',
+                                      hosts).run()
         self._actions_hosts(remove)
 
     def _libvirt_check_service(self):
@@ -394,6 +700,9 @@ class vm5k_deployment():
         name.text = 'default'
         SubElement(root, 'forward', attrib={'mode': 'bridge'})
         SubElement(root, 'bridge', attrib={'name': bridge})
+        mtu = self._get_bridge_mtu()
+        if mtu:
+            SubElement(root, 'mtu', attrib={'size': str(mtu)})
         fd, network_xml = mkstemp(dir='/tmp/', prefix='create_br_')
         f = fdopen(fd, 'w')
         f.write(prettify(root))
@@ -469,21 +778,101 @@ class vm5k_deployment():
                                  nobr_hosts).run()
 
             print('Waiting for network restart')
-            if_up = False
-            nmap_tries = 0
-            while (not if_up) and nmap_tries < 20:
-                sleep(20)
-                nmap_tries += 1
-                nmap = Process('nmap ' +
-                               ' '.join([host for host in nobr_hosts]) +
-                               ' -p 22').run()
-                for line in nmap.stdout.split('\n'):
-                    if 'Nmap done' in line:
-                        if_up = line.split()[2] == line.split()[5].replace('(',
-                                                                           '')
+            wait_hosts_up(nobr_hosts, timeout=400)
             print('Network has been restarted')
         print('All hosts have the bridge %s' % style.emph(name))
 
+    def _get_shards(self, shards='site'):
+        """Return the lists of hosts served by the same service node"""
+        if not shards:
+            return [list(self.hosts)]
+        sites_hosts = {}
+        for host in self.hosts:
+            sites_hosts.setdefault(get_host_site(host), []).append(host)
+        if shards == 'site':
+            return sites_hosts.values()
+        return [site_hosts[i:i + int(shards)]
+                for site_hosts in sites_hosts.itervalues()
+                for i in range(0, len(site_hosts), int(shards))]
+
+    def _tune_hosts_network(self, bridge='br0'):
+        """Size the neighbour table, the conntrack table and the
+        txqueuelen of the bridge ports from the number of VMs of each host
+        and of its layer 2 network (the site or the global kavlan), and
+        disable netfilter on the bridge. The configuration is written in
+        /etc/sysctl.d so that it can be applied several times. The MTU of
+        the hosts interfaces is never changed, so the MTU of the VMs is
+        removed if the network of the hosts does not carry it."""
+        hosts_vms = {host: 0 for host in self.hosts}
+        for vm in self.vms:
+            if vm['host'] in hosts_vms:
+                hosts_vms[vm['host']] += 1
+        networks = {}
+        for host in self.hosts:
+            network = 'global' if self.kavlan_site else get_host_site(host)
+            networks[network] = networks.get(network, 0) + 1 + \
+                hosts_vms[host]
+
+        mtu = self._get_bridge_mtu()
+        if mtu and not self._check_hosts_mtu(mtu, bridge):
+            logger.warning('The network of the hosts does not carry an MTU '
+                           'of %s, using the default MTU for the VMs', mtu)
+            for vm in self.vms:
+                vm['mtu'] = 0
+        hosts_cmds = {}
+        for host in self.hosts:
+            network = 'global' if self.kavlan_site else get_host_site(host)
+            neigh = max(1024, int(2 ** ceil(log(networks[network], 2))))
+            conntrack = max(65536,
+                            int(2 ** ceil(log(1024 * (hosts_vms[host] + 1),
+                                              2))))
+            txqueuelen = max(1000, 100 * hosts_vms[host])
+            conf = ['net.ipv4.neigh.default.gc_thresh1 = ' + str(neigh),
+                    'net.ipv4.neigh.default.gc_thresh2 = ' + str(2 * neigh),
+                    'net.ipv4.neigh.default.gc_thresh3 = ' + str(4 * neigh),
+                    'net.bridge.bridge-nf-call-iptables = 0',
+                    'net.bridge.bridge-nf-call-ip6tables = 0',
+                    'net.bridge.bridge-nf-call-arptables = 0',
+                    'net.netfilter.nf_conntrack_max = ' + str(conntrack)]
+            hosts_cmds[host] = 'printf "' + '\\n'.join(conf) + '\\n" ' + \
+                '> /etc/sysctl.d/60-vm5k-network.conf ; ' + \
+                'sysctl -e -q -p /etc/sysctl.d/60-vm5k-network.conf ; ' + \
+                'for port in `ls /sys/class/net/' + bridge + '/brif/`; ' + \
+                'do ip link set dev $port txqueuelen ' + str(txqueuelen) + \
+                '; done'
+        logger.detail('Tuning the network of %s hosts', len(hosts_cmds))
+        logger.debug(hosts_cmds)
+        tune = self.fact.get_remote('{{hosts_cmds.values()}}',
+                                    list(hosts_cmds.keys()))
+        for p in tune.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        tune.run()
+
+    def _get_bridge_mtu(self):
+        """Return the largest MTU of the VMs, or 0 if none is set"""
+        return max([int(vm.get('mtu', 0)) for vm in self.vms] + [0])
+
+    def _check_hosts_mtu(self, mtu, bridge='br0'):
+        """Return True if the bridges of the hosts have at least the given
+        MTU and if unfragmented packets of this size go from the first host
+        to the others"""
+        check = self.fact.get_remote('[ `cat /sys/class/net/' + bridge +
+                                     '/mtu` -ge ' + str(mtu) + ' ]',
+                                     self.hosts)
+        for p in check.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        check.run()
+        if any(p.exit_code != 0 for p in check.processes):
+            return False
+        if len(self.hosts) < 2:
+            return True
+        ping = SshProcess('for host in ' + ' '.join(self.hosts[1:]) +
+                          ' ; do ping -M do -c 1 -W 2 -s ' + str(mtu - 28) +
+                          ' $host > /dev/null || exit 1 ; done',
+                          self.hosts[0])
+        ping.ignore_exit_code = ping.nolog_exit_code = True
+        return ping.run().exit_code == 0
+
     def _get_bridge(self, hosts):
         """ """
         print('Retrieving bridge on hosts %s' %
@@ -533,47 +922,141 @@ class vm5k_deployment():
         self._actions_hosts(apt_conf)
         Local('rm ' + tmpsource + ' ' + tmppref + ' ' + tmpaptconf).run()
 
+    def _configure_apt_caches(self, upgrade=True, other_packages=None):
+        """Install an apt-cacher-ng server on one host by site, use it as
+        APT proxy for the hosts of the site, and download on it all the
+        packages that will be installed"""
+        self.apt_caches = {}
+        for site_hosts in self._get_shards('site'):
+            cache = get_fastest_host(site_hosts)
+            for host in site_hosts:
+                self.apt_caches[host] = cache
+        caches = list(set(self.apt_caches.values()))
+        setup_aptcacher_server(caches)
+
+        hosts_cmds = {host: 'echo \'Acquire::http::Proxy "http://' + cache +
+                      ':9999";\' > /etc/apt/apt.conf.d/proxy-guess'
+                      for host, cache in self.apt_caches.iteritems()}
+        proxy = self.fact.get_remote('{{hosts_cmds.values()}}',
+                                     list(hosts_cmds.keys())).run()
+        self._actions_hosts(proxy)
+
+        logger.info('Downloading the packages on %s',
+                    ', '.join([style.host(cache.split('.')[0])
+                               for cache in caches]))
+        cmd = 'export DEBIAN_MASTER=noninteractive ; apt-get update && ' + \
+            ('apt-get dist-upgrade -d -y --force-yes ; ' if upgrade else '') + \
+            'apt-get install -d -y --force-yes ' + base_packages + \
+            (' ' + other_packages.replace(',', ' ') if other_packages
+             else '') + ' ; ' + \
+            'apt-get install -d -y --force-yes -t %s-backports ' % \
+            self.debian_name + libvirt_packages
+        prefetch = self.fact.get_remote(cmd, caches)
+        for p in prefetch.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        prefetch.run()
+
+    def _install_packages_bundle(self, upgrade=True, other_packages=None):
+        """Download on one host the packages to be installed and their
+        dependencies, store them in an archive of the bundle directory,
+        broadcast it to all hosts and install it with dpkg. The archive is
+        reused by the deployments with the same environment and packages."""
+        packages = base_packages + (' ' + other_packages.replace(',', ' ')
+                                    if other_packages else '')
+        bundle_id = md5(' '.join([str(self.env_name), str(self.env_file),
+                                  str(upgrade), packages,
+                                  libvirt_packages])).hexdigest()
+        bundle = path.join(bundle_dir, 'vm5k-debs-' + bundle_id + '.tar')
+        if not path.exists(bundle):
+            host = get_fastest_host(self.hosts)
+            logger.info('Building the packages bundle on %s',
+                        style.host(host.split('.')[0]))
+            cmd = 'export DEBIAN_MASTER=noninteractive ; ' + \
+                'rm -rf /tmp/vm5k-debs ; mkdir -p /tmp/vm5k-debs/partial ; ' + \
+                'apt-get update && ' + \
+                ('apt-get dist-upgrade -d -y --force-yes ' +
+                 '-o Dir::Cache::archives=/tmp/vm5k-debs && ' if upgrade
+                 else '') + \
+                'apt-get install -d -y --force-yes --no-install-recommends ' + \
+                '-o Dir::Cache::archives=/tmp/vm5k-debs ' + packages + ' && ' + \
+                'apt-get install -d -y --force-yes -t %s-backports ' % \
+                self.debian_name + '-o Dir::Cache::archives=/tmp/vm5k-debs ' + \
+                libvirt_packages + ' && ' + \
+                'tar -C /tmp -cf /tmp/vm5k-debs.tar --exclude=partial ' + \
+                '--exclude=lock vm5k-debs'
+            build = SshProcess(cmd, host).run()
+            if not build.ok:
+                logger.error('Unable to build the packages bundle on %s',
+                             style.host(host))
+                exit()
+            if not path.exists(bundle_dir):
+                makedirs(bundle_dir)
+            self.fact.get_fileget([host], ['/tmp/vm5k-debs.tar'],
+                                  local_location=bundle_dir).run()
+            Local('mv ' + path.join(bundle_dir, 'vm5k-debs.tar') + ' ' +
+                  bundle).run()
+        else:
+            logger.info('Using the packages bundle %s', style.emph(bundle))
+
+        logger.info('Broadcasting the packages bundle to the hosts')
+        put = self.fact.get_fileput(self.hosts, [bundle],
+                                    remote_location='/tmp').run()
+        self._actions_hosts(put)
+        logger.info('Installing the packages bundle')
+        cmd = 'export DEBIAN_FRONTEND=noninteractive ; cd /tmp && ' + \
+            'rm -rf vm5k-debs && tar -xf ' + bundle.split('/')[-1] + ' && ' + \
+            'dpkg --force-confdef --force-confold -i vm5k-debs/*.deb && ' + \
+            'dpkg --configure -a'
+        install = self.fact.get_remote(cmd, self.hosts).run()
+        self._actions_hosts(install)
+
+    def _update_apt(self):
+        """Update the packages lists of all hosts"""
+        logger.info('Updating packages lists')
+        update = self.fact.get_remote('apt-get update', self.hosts).run()
+        self._actions_hosts(update)
+
     def _upgrade_hosts(self):
         """Dist upgrade performed on all hosts"""
         logger.info('Upgrading packages')
         cmd = "echo 'debconf debconf/frontend select noninteractive' | debconf-set-selections ; " + \
               "echo 'debconf debconf/priority select critical' | debconf-set-selections ;      " + \
-              "export DEBIAN_MASTER=noninteractive ; apt-get update ; " + \
+              "export DEBIAN_MASTER=noninteractive ; " + \
               "apt-get dist-upgrade -y --force-yes -o Dpkg::Options::='--force-confdef' " + \
               "-o Dpkg::Options::='--force-confold' "
         upgrade = self.fact.get_remote(cmd, self.hosts).run()
         self._actions_hosts(upgrade)
 
-    def _install_packages(self, other_packages=None, launch_disk_copy=True):
+    def _install_packages(self, other_packages=None, launch_disk_copy=True,
+                          update=True):
         """Installation of required packages on the hosts"""
-        base_packages = 'uuid-runtime bash-completion taktuk locate htop init-system-helpers netcat-traditional'
         logger.info('Installing base packages \n%s', style.emph(base_packages))
-        cmd = 'export DEBIAN_MASTER=noninteractive ; apt-get update && apt-get ' + \
+        cmd = 'export DEBIAN_MASTER=noninteractive ; ' + \
+            ('apt-get update && ' if update else '') + 'apt-get ' + \
             'install -y --force-yes --no-install-recommends ' + base_packages
         install_base = self.fact.get_remote(cmd, self.hosts).run()
         self._actions_hosts(install_base)
         if launch_disk_copy:
             self._start_disk_copy()
-        libvirt_packages = 'libvirt-bin virtinst python2.7 python-pycurl python-libxml2 qemu-kvm nmap libgmp10'
         logger.info('Installing libvirt packages \n%s',
                     style.emph(libvirt_packages))
-        cmd = 'export DEBIAN_MASTER=noninteractive ; apt-get update && apt-get install -y --force-yes '+\
+        cmd = 'export DEBIAN_MASTER=noninteractive ; apt-get install -y --force-yes '+\
             '-o Dpkg::Options::="--force-confdef" -o Dpkg::Options::="--force-confold" -t %s-backports ' % self.debian_name+\
             libvirt_packages
         install_libvirt = self.fact.get_remote(cmd, self.hosts).run()
         self._actions_hosts(install_libvirt)
         if other_packages:
-            self._other_packages(other_packages)
+            self._other_packages(other_packages, update=False)
 
-    def _other_packages(self, other_packages=None):
+    def _other_packages(self, other_packages=None, update=True):
         """Installation of packages"""
         other_packages = other_packages.replace(',', ' ')
         logger.info('Installing extra packages \n%s',
                     style.emph(other_packages))
 
         cmd = 'export DEBIAN_MASTER=noninteractive ; ' + \
-            'apt-get update && apt-get install -y --force-yes ' + \
-            other_packages
+            ('apt-get update && ' if update else '') + \
+            'apt-get install -y --force-yes ' + other_packages
         install_extra = self.fact.get_remote(cmd, self.hosts).run()
         self._actions_hosts(install_extra)
 
@@ -631,15 +1114,19 @@ class vm5k_deployment():
             # mono site
             self.ip_mac = resources[resources.keys()[0]]['ip_mac']
             self.kavlan = resources[resources.keys()[0]]['kavlan']
+            self.network = resources[resources.keys()[0]].get('network')
         elif 'global' in resources:
             # multi site in a global kavlan
             self.ip_mac = resources['global']['ip_mac']
             self.kavlan = resources['global']['kavlan']
             self.kavlan_site = resources['global']['site']
+            self.network = resources['global'].get('network')
         else:
             # multi site in prod network
             self.ip_mac = {site: resource['ip_mac']
                            for site, resource in resources.iteritems()}
+            self.network = {site: resource.get('network')
+                            for site, resource in resources.iteritems()}
         if isinstance(self.ip_mac, list) and len(self.ip_mac) == 0:
             logger.error('No ip_range given in the resources')
             exit()
@@ -649,6 +1136,33 @@ class vm5k_deployment():
                     logger.error('No ip_range given in the resources')
                     exit()
 
+    def _get_vms_network(self):
+        """Return the list of (mac, ip, netmask, gateway, dns) of the VMs,
+        the service node of the VM host being used as gateway and dns when
+        the resources do not give them. Exit if a VM has no network, as
+        the DHCP of the service nodes has not been configured."""
+        service_nodes = {}
+        for service_node, shard_hosts in getattr(self, 'service_nodes',
+                                                 {}).iteritems():
+            for host in shard_hosts:
+                service_nodes[host] = get_server_ip(service_node)
+        vms_network = []
+        for vm in self.vms:
+            network = self.network.get(get_host_site(vm['host'])) \
+                if isinstance(self.ip_mac, dict) else self.network
+            service_ip = service_nodes.get(vm['host'])
+            gateway = network.get('gateway') or service_ip if network \
+                else None
+            dns = network.get('dns') or service_ip if network else None
+            if not network or not network.get('netmask') or not gateway \
+                    or not dns:
+                logger.error('No network configuration for %s, use %s',
+                             style.vm(vm['id']), style.emph('dhcp'))
+                exit()
+            vms_network.append((vm['mac'], vm['ip'], network['netmask'],
+                                gateway, dns))
+        return vms_network
+
     def _get_resources_elements(self, resources=None):
         """ """
         self.sites = sorted([site for site in resources.keys()
@@ -736,6 +1250,21 @@ class vm5k_deployment():
                     'hdd': int(_default_xml_value('hdd')),
                     'backing_file': _default_xml_value('backing_file'),
                     'real_file': _default_xml_value('real_file'),
+                    'disk_cache': _default_xml_value('disk_cache'),
+                    'disk_io': _default_xml_value('disk_io'),
+                    'cluster_size': int(_default_xml_value('cluster_size')),
+                    'preallocation': _default_xml_value('preallocation'),
+                    'lazy_refcounts': _default_xml_value('lazy_refcounts')
+                    in [True, 'True', 'true', 'on'],
+                    'hugepages': _default_xml_value('hugepages')
+                    in [True, 'True', 'true', 'on'],
+                    'mem_lock': _default_xml_value('mem_lock')
+                    in [True, 'True', 'true', 'on'],
+                    'numatune': _default_xml_value('numatune'),
+                    'net_queues': _default_xml_value('net_queues'),
+                    'net_driver': _default_xml_value('net_driver'),
+                    'txqueuelen': int(_default_xml_value('txqueuelen')),
+                    'mtu': int(_default_xml_value('mtu')),
                     'host': host.get('id'),
                     'state': 'KO'})
         return vms
@@ -797,6 +1326,18 @@ class vm5k_deployment():
                                            'hdd': str(vm['hdd']),
                                            'backing_file': vm['backing_file'],
                                            'real_file': str(vm['real_file']),
+                                           'disk_cache': vm['disk_cache'],
+                                           'disk_io': vm['disk_io'],
+                                           'cluster_size': str(vm['cluster_size']),
+                                           'preallocation': vm['preallocation'],
+                                           'lazy_refcounts': str(vm['lazy_refcounts']),
+                                           'hugepages': str(vm['hugepages']),
+                                           'mem_lock': str(vm['mem_lock']),
+                                           'numatune': vm['numatune'],
+                                           'net_queues': str(vm['net_queues']),
+                                           'net_driver': vm['net_driver'],
+                                           'txqueuelen': str(vm['txqueuelen']),
+                                           'mtu': str(vm['mtu']),
                                            'state': vm['state']})
 
     def _print_state_compact(self):
@@ -16,27 +16,29 @@
 # You should have received a copy of the GNU General Public License
 # along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
 
-from os import path, mkdir, listdir, remove
+from os import path, mkdir, makedirs, listdir, remove
+from hashlib import md5
 from pprint import pformat
-from xml.etree.ElementTree import fromstring, parse, ElementTree
 import time
 import datetime
-from execo import Host, SshProcess, sleep, Remote, TaktukRemote, Get, Put, ChainPut, \
+import json
+from math import sqrt
+from execo import Host, sleep, Remote, TaktukRemote, Get, Put, ChainPut, \
     SequentialActions, ParallelActions, format_date, format_duration, \
-    default_connection_params
-from execo.time_utils import timedelta_to_seconds
+    default_connection_params, Process
+from execo.time_utils import timedelta_to_seconds, get_seconds
 from execo.config import SSH, SCP, TAKTUK, CHAINPUT
 from execo.log import style
 from execo.action import ActionFactory
-from execo_g5k import default_frontend_connection_params, get_oar_job_info, \
-    get_cluster_site, OarSubmission, \
-    oarsub, get_oar_job_nodes, wait_oar_job_start, oardel, get_host_attributes
+from execo_g5k import get_oar_job_info, get_cluster_site, oarsub, oardel, \
+    get_host_attributes
 from execo_g5k.planning import get_planning, compute_slots, get_jobs_specs
 from vm5k import config, define_vms, create_disks, install_vms, start_vms, wait_vms_have_started,\
     destroy_vms, rm_qcow2_disks, vm5k_deployment, get_oar_job_vm5k_resources, print_step
-from vm5k.config import default_vm
+from vm5k.config import default_vm, artifact_dir
+from vm5k.topology import get_host_topology
 from execo_engine import Engine, ParamSweeper, sweep, slugify, logger
-from threading import Thread, Lock
+from threading import Thread, Lock, Event
 
 
 default_connection_params['user'] = 'root'
@@ -87,6 +89,11 @@ class vm5k_engine(Engine):
         self.options_parser.add_option("-o", dest="outofchart",
                     help="Run the engine outside days",
                     action="store_true")
+        self.options_parser.add_option("--oar-poll", dest="oar_poll_interval",
+                    help="interval in seconds between two polls of the " + \
+                    "OAR job state",
+                    type="int",
+                    default=30)
         self.options_parser.add_option("--no-hosts-setup",
                                        action="store_true",
                                        help="use hosts in current state")
@@ -95,6 +102,14 @@ class vm5k_engine(Engine):
 
         self.frontend = None
         self.parameters = None
+        self.job_watcher = None
+        self._job_watcher_lock = Lock()
+        # cache keys of the installed artifacts, by name
+        self.artifacts = {}
+        self.tail_jobs = []
+        # number of standard deviations added to the mean duration of a
+        # combination class to decide if it can end before the job
+        self.admission_n_sigma = 2
 
     def force_options(self):
         """Allow to override default options in derived engine"""
@@ -111,6 +126,52 @@ class vm5k_engine(Engine):
         logger.info('% s combinations', len(sweeps))
         self.sweeper = ParamSweeper(path.join(self.result_dir, "sweeps"),
                                     sweeps)
+        self.comb_durations = comb_duration_estimator(
+            path.join(self.result_dir, "comb_durations.json"))
+
+    def comb_class(self, comb):
+        """Return the key of the combinations expected to have the same
+        duration, i.e. the combination without its iteration parameter"""
+        return slugify(dict((key, value) for key, value in comb.iteritems()
+                            if key != 'iteration'))
+
+    def admit_comb(self, comb, running=True):
+        """Return False if the combination is not expected to end before
+        the end of the current job. The duration is only estimated once a
+        combination of the same class has been done, so the first one of
+        each class is always admitted. It is also always admitted when no
+        other combination is running on the job (running=False), as keeping
+        it for the next job would not free the current one."""
+        remaining = self.job_watcher.walltime_remaining() \
+            if self.job_watcher is not None else None
+        estimate = self.comb_durations.estimate(self.comb_class(comb),
+                                                self.admission_n_sigma)
+        if not running or remaining is None or estimate is None or \
+                estimate < remaining:
+            return True
+        logger.info('%s is expected to last %s but job %s ends in %s',
+                    slugify(comb), format_duration(estimate),
+                    self.oar_job_id, format_duration(remaining))
+        return False
+
+    def fits_walltime(self, comb):
+        """Return False if the combination is not expected to end before
+        the walltime of a new job"""
+        estimate = self.comb_durations.estimate(self.comb_class(comb),
+                                                self.admission_n_sigma)
+        return estimate is None or \
+            estimate < get_seconds(self.options.walltime)
+
+    def _timed_workflow(self, comb, hosts, ip_mac):
+        """Run the workflow and record its duration if the combination
+        has been done"""
+        start = time.time()
+        try:
+            self.workflow(comb, hosts, ip_mac)
+        finally:
+            if comb in self.sweeper.get_done():
+                self.comb_durations.add(self.comb_class(comb),
+                                        time.time() - start)
 
     def _get_nodes(self, starttime, endtime):
         """ """
@@ -170,8 +231,55 @@ class vm5k_engine(Engine):
         """
         self.resources = get_oar_job_vm5k_resources([(self.oar_job_id,
                                                       self.frontend)])
-        self.hosts = self.resources[get_cluster_site(self.cluster)]['hosts']
-        self.ip_mac = self.resources[get_cluster_site(self.cluster)]['ip_mac']
+        site = get_cluster_site(self.cluster)
+        if site not in self.resources:
+            logger.error('Unable to retrieve the resources of job %s on %s',
+                         self.oar_job_id, style.emph(site))
+            exit()
+        self.hosts = self.resources[site]['hosts']
+        self.ip_mac = self.resources[site]['ip_mac']
+
+    def start_job_watcher(self):
+        """Start polling the state of the current OAR job in background,
+        replacing the watcher of a previous job. It can be called by
+        several threads."""
+        with self._job_watcher_lock:
+            if self.job_watcher is not None:
+                if self.job_watcher.oar_job_id == self.oar_job_id:
+                    return self.job_watcher
+                self.job_watcher.stop()
+            self.job_watcher = oar_job_watcher(self.oar_job_id,
+                                               self.frontend,
+                                               self.options.oar_poll_interval)
+            self.job_watcher.start()
+            return self.job_watcher
+
+    def is_job_alive(self):
+        """Return the last OAR job info published by the job watcher"""
+        return self.start_job_watcher().get_info()
+
+    def reserve_next_job(self, threads):
+        """Keep the current job until the threads of its running
+        combinations end and make the reservation of the next job, so that
+        its hosts are deployed during the tail of the current one"""
+        logger.info('Reserving the next job while %s combinations end on %s',
+                    len(threads), self.oar_job_id)
+        self.tail_jobs.append((self.oar_job_id, self.frontend, threads))
+        self.make_reservation()
+
+    def release_tail_jobs(self, wait=False):
+        """Delete the previous jobs whose combinations have ended"""
+        for tail_job in list(self.tail_jobs):
+            oar_job_id, frontend, threads = tail_job
+            if wait:
+                for t in threads:
+                    t.join()
+            if any(t.is_alive() for t in threads):
+                continue
+            if not self.options.keep_alive:
+                logger.info('Deleting job %s', oar_job_id)
+                oardel([(oar_job_id, frontend)])
+            self.tail_jobs.remove(tail_job)
 
     def setup_hosts(self):
         """Launch the vm5k_deployment """
@@ -192,6 +300,77 @@ class vm5k_engine(Engine):
         backing_files = self.options.backing_files.split(',')
         setup._create_backing_file(disks=backing_files)
 
+    def install_artifact(self, setup, name, source, dirname,
+                         build_cmd='./configure --prefix=/usr/local/ && make',
+                         depends=None):
+        """Install a software built from its source archive on the hosts of
+        the deployment. It is built on one host only and installed in a
+        staging directory, that is stored in the artifact directory and
+        broadcasted to all the hosts. The build is reused as long as the
+        source, the build command, the environment and the builds of its
+        dependencies do not change.
+
+        :param setup: the vm5k_deployment of the hosts
+
+        :param name: the name of the software
+
+        :param source: path of the source archive on the frontend
+
+        :param dirname: directory created by the extraction of the source
+
+        :param build_cmd: command run in dirname before ``make install``
+
+        :param depends: the names of the artifacts installed before that
+          are used by the build
+        """
+        depends = depends if depends else []
+        missing = [dep for dep in depends if dep not in self.artifacts]
+        if missing:
+            logger.error('%s must be installed before %s',
+                         ', '.join(missing), name)
+            return False
+        source_hash = Process('md5sum -b ' + source).run().stdout.split(' ')[0]
+        key = md5(' '.join([source_hash, build_cmd,
+                            str(self.options.env_name),
+                            str(self.options.env_file)] +
+                           [self.artifacts[dep] for dep in depends])
+                  ).hexdigest()
+        artifact = dirname + '-' + key + '.tgz'
+        if not path.exists(path.join(artifact_dir, artifact)):
+            host = setup.hosts[0]
+            logger.info('Building %s on %s', style.emph(name),
+                        style.host(host.split('.')[0]))
+            put = setup.fact.get_fileput([host], [source]).run()
+            setup._actions_hosts(put)
+            cmd = 'rm -rf /tmp/vm5k-artifact ' + dirname + ' && ' + \
+                'tar xf ' + source.split('/')[-1] + ' && cd ' + dirname + \
+                ' && ' + build_cmd + ' && ' + \
+                'make install DESTDIR=/tmp/vm5k-artifact && ' + \
+                'tar -C /tmp/vm5k-artifact -czf /tmp/' + artifact + ' .'
+            build = setup.fact.get_remote(cmd, [host]).run()
+            if not build.ok:
+                logger.error('Unable to build %s on %s', name, host)
+                return False
+            if not path.exists(artifact_dir):
+                makedirs(artifact_dir)
+            setup.fact.get_fileget([host], ['/tmp/' + artifact],
+                                   local_location=artifact_dir).run()
+        else:
+            logger.info('Using the build of %s from %s', style.emph(name),
+                        artifact_dir)
+
+        logger.info('Installing %s on the hosts', style.emph(name))
+        put = setup.fact.get_fileput(setup.hosts,
+                                     [path.join(artifact_dir, artifact)],
+                                     remote_location='/tmp').run()
+        setup._actions_hosts(put)
+        install = setup.fact.get_remote('tar -C / -xzf /tmp/' + artifact +
+                                        ' && ldconfig', setup.hosts).run()
+        setup._actions_hosts(install)
+        if install.ok:
+            self.artifacts[name] = key
+        return install.ok
+
 
 class vm5k_engine_para(vm5k_engine):
     """A engine that use threads to treate combination in parallel
@@ -281,6 +460,8 @@ class vm5k_engine_para(vm5k_engine):
                     if job_is_dead:
                         break
 
+                    self.release_tail_jobs()
+
                     # Getting the next combination
                     comb = self.sweeper.get_next()
                     if not comb:
@@ -291,6 +472,21 @@ class vm5k_engine_para(vm5k_engine):
                                     del threads[t]
                             logger.info('Waiting for threads to complete')
                             sleep(20)
+                        self.release_tail_jobs(wait=True)
+                        break
+
+                    # Keeping the combination for the next job if it is not
+                    # expected to end before the current one
+                    if not self.admit_comb(comb, len(threads) > 0):
+                        if not self.fits_walltime(comb):
+                            logger.error('%s is expected to last longer than '
+                                         'the walltime %s, skipping it',
+                                         slugify(comb),
+                                         self.options.walltime)
+                            self.sweeper.skip(comb)
+                            continue
+                        self.sweeper.cancel(comb)
+                        self.reserve_next_job(threads)
                         break
 
                     used_hosts = available_hosts[0:self.options.n_nodes]
@@ -300,7 +496,7 @@ class vm5k_engine_para(vm5k_engine):
                     used_ip_mac = available_ip_mac[0:n_vm]
                     available_ip_mac = available_ip_mac[n_vm:]
 
-                    t = Thread(target=self.workflow,
+                    t = Thread(target=self._timed_workflow,
                                args=(comb, used_hosts, used_ip_mac))
                     threads[t] = {'hosts': used_hosts, 'ip_mac': used_ip_mac}
                     logger.debug('Threads: %s', len(threads))
@@ -321,57 +517,135 @@ class vm5k_engine_para(vm5k_engine):
                     oardel([(self.oar_job_id, self.frontend)])
                 else:
                     logger.info('Keeping job alive for debugging')
-    
-    def is_job_alive(self):
-        rez=get_oar_job_info(self.oar_job_id, self.frontend)
-        while 'state' not in rez:
-            logger.info('Retrying getting oar_job_info')
-            rez=get_oar_job_info(self.oar_job_id, self.frontend)
-        return rez
+            for oar_job_id, frontend, _ in self.tail_jobs:
+                if not self.options.keep_alive:
+                    oardel([(oar_job_id, frontend)])
+            if self.job_watcher is not None:
+                self.job_watcher.stop()
+
+
+class comb_duration_estimator():
+    """Running mean and variance of the duration of the combinations by
+    class, updated online with the Welford algorithm and persisted in a
+    JSON file of the result directory."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self._lock = Lock()
+        self.stats = {}
+        if path.exists(fname):
+            with open(fname) as f:
+                self.stats = json.load(f)
+
+    def add(self, key, duration):
+        """Add the duration of a done combination to the statistics"""
+        with self._lock:
+            n, mean, m2 = self.stats.get(key, (0, 0., 0.))
+            n += 1
+            delta = duration - mean
+            mean += delta / n
+            m2 += delta * (duration - mean)
+            self.stats[key] = [n, mean, m2]
+            with open(self.fname, 'w') as f:
+                json.dump(self.stats, f)
+
+    def estimate(self, key, n_sigma=2):
+        """Return the mean duration plus n_sigma standard deviations, or
+        None if no combination of this class has been done"""
+        with self._lock:
+            if key not in self.stats:
+                return None
+            n, mean, m2 = self.stats[key]
+        std = sqrt(m2 / (n - 1)) if n > 1 else 0.
+        return mean + n_sigma * std
+
+
+class oar_job_watcher(Thread):
+    """A daemon thread that polls the OAR API for the state of a job at a
+    given interval, with an exponential backoff on errors, and publishes
+    the job info and the remaining walltime to the engine."""
+
+    def __init__(self, oar_job_id, frontend, interval=30, max_interval=600):
+        """:param oar_job_id: the id of the OAR job to watch
+
+        :param frontend: the site of the job
+
+        :param interval: the number of seconds between two polls
+
+        :param max_interval: the maximum delay between two polls when the
+          API returns errors
+        """
+        super(oar_job_watcher, self).__init__()
+        self.daemon = True
+        self.oar_job_id = oar_job_id
+        self.frontend = frontend
+        self.interval = interval
+        self.max_interval = max_interval
+        self._info = {}
+        self._updated = None
+        self._lock = Lock()
+        self._has_info = Event()
+        self._stopped = Event()
+
+    def run(self):
+        delay = self.interval
+        while not self._stopped.is_set():
+            try:
+                info = get_oar_job_info(self.oar_job_id, self.frontend)
+            except Exception, e:
+                logger.warning('Unable to get oar_job_info of %s: %s',
+                               self.oar_job_id, e)
+                info = {}
+            if 'state' in info:
+                with self._lock:
+                    self._info = info
+                    self._updated = time.time()
+                self._has_info.set()
+                delay = self.interval
+            else:
+                delay = min(2 * delay, self.max_interval)
+                logger.detail('No state for job %s, retrying in %ss',
+                              self.oar_job_id, delay)
+            self._stopped.wait(delay)
+
+    def stop(self):
+        """Stop polling the API"""
+        self._stopped.set()
+
+    def get_info(self, timeout=None):
+        """Return a copy of the last job info, waiting for the first one
+        at most timeout seconds (max_interval by default), or an info with
+        an Unknown state if the API has not given it"""
+        if not self._has_info.wait(self.max_interval if timeout is None
+                                   else timeout):
+            logger.warning('No state for job %s after %ss', self.oar_job_id,
+                           self.max_interval if timeout is None else timeout)
+            return {'state': 'Unknown'}
+        with self._lock:
+            return dict(self._info)
+
+    @property
+    def state(self):
+        """The last known state of the job"""
+        return self.get_info()['state']
+
+    def walltime_remaining(self):
+        """Return the number of seconds before the end of the job, or None
+        if the job has not started"""
+        info = self.get_info()
+        if info.get('start_date') is None or info.get('walltime') is None:
+            return None
+        return info['start_date'] + info['walltime'] - time.time()
 
 
 
 def get_cpu_topology(cluster, xpdir=None):
-    """ """
+    """Return the list of the CPU of each NUMA cell of the cluster hosts,
+    using the shared topology cache of vm5k.topology"""
     logger.info('Determining the architecture of cluster ' + \
                 style.emph(cluster))
-    root = None
-    # Trying to reed topology from a directory
-    if xpdir:
-        fname = xpdir + '/topo_' + cluster + '.xml'
-        try:
-            tree = parse(fname)
-            root = tree.getroot()
-        except:
-            logger.info('No cache file found, will reserve a node and ' + \
-                        'determine topology from virsh capabilities')
-            pass
-
-    if root is None:
-        frontend = get_cluster_site(cluster)
-        submission = OarSubmission(
-            resources="{cluster='" + cluster + "'}/nodes=1",
-            walltime="0:02:00",
-            job_type="allow_classic_ssh")
-        ((job_id, _), ) = oarsub([(submission, frontend)])
-        wait_oar_job_start(job_id, frontend)
-        host = get_oar_job_nodes(job_id, frontend)[0]
-        capa = SshProcess('virsh capabilities', host,
-            connection_params={'user': default_frontend_connection_params['user']}
-            ).run()
-        oardel([(job_id, frontend)])
-        root = fromstring(capa.stdout)
-        if xpdir is not None:
-            tree = ElementTree(root)
-            tree.write(fname)
-
-    cpu_topology = []
-    i_cell = 0
-    for cell in root.findall('.//cell'):
-        cpu_topology.append([])
-        for cpu in cell.findall('.//cpu'):
-            cpu_topology[i_cell].append(int(cpu.attrib['id']))
-        i_cell += 1
+    cpu_topology = get_host_topology(cluster, xpdir,
+                                     need_cells=True).cells_cpus()
     logger.info(pformat(cpu_topology))
     return cpu_topology
 
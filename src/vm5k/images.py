@@ -0,0 +1,816 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Distribute the virtual machines images from the frontend to the hosts"""
+import re
+import gzip
+import ctypes
+import struct
+from mmap import mmap, ACCESS_READ
+from zlib import adler32
+from ctypes.util import find_library
+from os import fdopen, path, lseek, read, write, strerror, SEEK_SET
+from hashlib import md5
+from tempfile import mkstemp
+from threading import Thread
+from socket import getfqdn
+from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+from SocketServer import ThreadingMixIn
+from execo import logger, Process, SshProcess, TaktukRemote, TaktukPut, \
+    Timer
+from execo.log import style
+from execo_g5k.utils import hosts_list
+
+
+chunks_script = """import sys
+from hashlib import md5
+try:
+    f = open(sys.argv[1], 'rb')
+except IOError:
+    sys.exit(0)
+while True:
+    data = f.read(int(sys.argv[2]))
+    if not data:
+        break
+    print md5(data).hexdigest()
+"""
+
+sparse_send_script = """import os, sys, struct
+SEEK_DATA, SEEK_HOLE = 3, 4
+block = 2 ** 20
+zeros = chr(0) * block
+f = open(sys.argv[1], 'rb')
+fd = f.fileno()
+size = os.fstat(fd).st_size
+
+
+def extents(pos):
+    while pos < size:
+        try:
+            start = os.lseek(fd, pos, SEEK_DATA)
+            end = os.lseek(fd, start, SEEK_HOLE)
+        except OSError, e:
+            if e.errno != 6:
+                yield pos, size
+            return
+        yield start, end
+        pos = end
+
+for start, end in extents(int(sys.argv[2])):
+    f.seek(start)
+    while start < end:
+        data = f.read(min(block, end - start))
+        if not data:
+            break
+        if data != zeros[:len(data)]:
+            sys.stdout.write(struct.pack('!QQ', start, len(data)) + data)
+        start += len(data)
+sys.stdout.write(struct.pack('!QQ', size, 0))
+"""
+
+sparse_receive_script = """import sys, struct, time
+start_time = time.time()
+try:
+    f = open(sys.argv[1], 'r+b')
+except IOError:
+    f = open(sys.argv[1], 'wb')
+f.truncate(int(sys.argv[2]))
+
+
+def read(length):
+    data = sys.stdin.read(length)
+    if len(data) < length:
+        sys.exit(1)
+    return data
+
+total = 0
+while True:
+    pos, length = struct.unpack('!QQ', read(16))
+    if length == 0:
+        f.truncate(pos)
+        break
+    f.seek(pos)
+    f.write(read(length))
+    total += length
+f.close()
+sys.stderr.write('%d bytes copied, %f s' % (total, time.time() - start_time))
+"""
+
+signature_script = """import sys
+from zlib import adler32
+from hashlib import md5
+f = open(sys.argv[1], 'rb')
+while True:
+    data = f.read(int(sys.argv[2]))
+    if not data:
+        break
+    print adler32(data) & 0xffffffff, md5(data).hexdigest()
+"""
+
+patch_script = """import os, sys, gzip, struct
+from hashlib import md5
+block = 2 ** 20
+zeros = chr(0) * block
+old = open(sys.argv[1], 'rb')
+delta = gzip.open(sys.argv[2], 'rb')
+new = sys.argv[1] + '.new'
+out = open(new, 'wb')
+checksum = md5()
+
+
+def read(length):
+    data = delta.read(length)
+    if len(data) < length:
+        sys.exit(1)
+    return data
+
+
+def write(data):
+    checksum.update(data)
+    if data == zeros[:len(data)]:
+        out.seek(len(data), 1)
+    else:
+        out.write(data)
+
+while True:
+    op = read(1)
+    if op == 'E':
+        out.truncate(struct.unpack('!Q', read(8))[0])
+        break
+    elif op == 'C':
+        offset, length = struct.unpack('!QQ', read(16))
+        old.seek(offset)
+        while length > 0:
+            data = old.read(min(block, length))
+            if not data:
+                sys.exit(1)
+            write(data)
+            length -= len(data)
+    else:
+        length = struct.unpack('!Q', read(8))[0]
+        while length > 0:
+            data = read(min(block, length))
+            write(data)
+            length -= len(data)
+out.close()
+if checksum.hexdigest() != sys.argv[3]:
+    os.remove(new)
+    sys.exit(1)
+os.rename(new, sys.argv[1])
+"""
+
+
+def chunk_checksums(image, chunk_size):
+    """Return the list of the md5 of the chunks of chunk_size MiB of image"""
+    checksums = []
+    with open(image, 'rb') as f:
+        while True:
+            data = f.read(chunk_size * 2 ** 20)
+            if not data:
+                break
+            checksums.append(md5(data).hexdigest())
+    return checksums
+
+
+def image_delta_file(image, signatures, block_size, delta):
+    """Write in delta the gzipped instructions that rebuild image from a
+    copy whose blocks of block_size bytes have the given signatures, a
+    list of (adler32, md5) tuples, and return the number of bytes copied
+    from the copy and sent as literal.
+
+    The blocks of the image are looked up at aligned offsets first. The
+    first two blocks that are not found after a block that is found, or
+    at the start, are also searched with a rolling checksum at the next
+    block_size offsets, so that an insertion or a deletion smaller than a
+    block only costs its own blocks."""
+    index = {}
+    for i_block, (weak, strong) in enumerate(signatures):
+        index.setdefault(weak, []).append((i_block, strong))
+    out = gzip.open(delta, 'wb', 6)
+    size = path.getsize(image)
+    stats = {'copied': 0, 'literal': 0}
+    copy = [0, 0]
+
+    def find(data, weak):
+        if weak in index:
+            strong = md5(data).hexdigest()
+            for i_block, block_strong in index[weak]:
+                if block_strong == strong:
+                    return i_block
+        return None
+
+    def flush_copy():
+        if copy[1] > 0:
+            out.write('C' + struct.pack('!QQ', copy[0], copy[1]))
+            stats['copied'] += copy[1]
+        copy[0], copy[1] = 0, 0
+
+    def write_literal(data, start, end):
+        if end <= start:
+            return
+        flush_copy()
+        out.write('L' + struct.pack('!Q', end - start))
+        for offset in range(start, end, 2 ** 20):
+            out.write(data[offset:min(end, offset + 2 ** 20)])
+        stats['literal'] += end - start
+
+    def write_copy(offset, length):
+        if copy[1] > 0 and copy[0] + copy[1] == offset:
+            copy[1] += length
+        else:
+            flush_copy()
+            copy[0], copy[1] = offset, length
+
+    if size > 0:
+        f = open(image, 'rb')
+        data = mmap(f.fileno(), 0, access=ACCESS_READ)
+        pos, literal_start, misses = 0, 0, 0
+        while pos < size:
+            block = data[pos:pos + block_size]
+            weak = adler32(block) & 0xffffffff
+            i_block = find(block, weak) if index else None
+            if i_block is None and misses < 2 and index and \
+                    len(block) == block_size:
+                a, b = weak & 0xffff, weak >> 16
+                for shift in range(1, min(block_size, size - pos -
+                                          block_size + 1)):
+                    out_byte = ord(data[pos + shift - 1])
+                    in_byte = ord(data[pos + shift + block_size - 1])
+                    a = (a - out_byte + in_byte) % 65521
+                    b = (b - block_size * out_byte + a - 1) % 65521
+                    if (b << 16 | a) in index:
+                        block = data[pos + shift:pos + shift + block_size]
+                        i_block = find(block, b << 16 | a)
+                        if i_block is not None:
+                            pos += shift
+                            break
+            if i_block is None:
+                pos += block_size
+                misses += 1
+            else:
+                write_literal(data, literal_start, pos)
+                write_copy(i_block * block_size, len(block))
+                pos += len(block)
+                literal_start, misses = pos, 0
+        write_literal(data, literal_start, size)
+        data.close()
+        f.close()
+    flush_copy()
+    out.write('E' + struct.pack('!Q', size))
+    out.close()
+    return stats['copied'], stats['literal']
+
+
+class image_broadcast(Thread):
+    """Copy images of the frontend to the hosts, through a pipeline of
+    netcat along a chain (fanout=1) or a tree of hosts, where each host
+    writes the stream in its copy while forwarding it to its children.
+
+    With sparse, only the allocated and non zero extents of the image are
+    sent, and the holes of the copy are kept. With compression, a gzip
+    level from 1 (fastest) to 9, the stream is compressed by the source and
+    only decompressed by the hosts before being written.
+
+    The image is checked by chunks of chunk_size MiB after the transfer,
+    and is sent again from the first bad chunk to the hosts that do not
+    have a complete copy. The hosts that already have a complete copy are
+    used as source instead of the frontend.
+
+    It can be used as an execo action, with start(), wait(), ended and ok.
+    """
+    scripts_contents = [('chunks', chunks_script),
+                        ('send', sparse_send_script),
+                        ('receive', sparse_receive_script)]
+
+    def __init__(self, images, hosts, remote_dir='/tmp', chunk_size=64,
+                 fanout=1, port=12321, max_tries=3, sparse=False,
+                 compression=None):
+        """:param images: a list of paths of images on the frontend
+
+        :param hosts: the hosts to copy the images on
+
+        :param remote_dir: directory of the hosts where an image is copied
+          as orig_<image name>
+
+        :param chunk_size: size of the checked chunks, in MiB
+
+        :param fanout: number of children of each host of the tree
+
+        :param port: TCP port used to forward the image between hosts
+
+        :param max_tries: number of transfers before giving up
+
+        :param sparse: send only the data extents of the image
+
+        :param compression: the gzip level of the stream, None to send it
+          uncompressed
+        """
+        Thread.__init__(self)
+        self.daemon = True
+        self.images = list(images)
+        self.hosts = list(hosts)
+        self.remote_dir = remote_dir
+        self.chunk_size = chunk_size
+        self.fanout = fanout
+        self.port = port
+        self.max_tries = max_tries
+        self.sparse = sparse
+        self.compression = compression
+        self.ended = False
+        self.ok = False
+        self.failed_hosts = []
+        self.throughput = {}
+
+    def wait(self):
+        self.join()
+        return self
+
+    def run(self):
+        self.scripts = {}
+        try:
+            self._put_scripts()
+            self.ok = True
+            for image in self.images:
+                self.image = image
+                self.remote_file = self.remote_dir + '/orig_' + \
+                    image.split('/')[-1]
+                self._broadcast()
+        finally:
+            if len(self.scripts) > 0:
+                Process('rm -f ' + ' '.join(self.scripts.values())).run()
+            self.ended = True
+
+    def _broadcast(self):
+        timer = Timer()
+        checksums = chunk_checksums(self.image, self.chunk_size)
+        size = path.getsize(self.image)
+        targets = self.hosts
+        sent = 0
+        for i_try in range(self.max_tries + 1):
+            first_bad = self._check_hosts(targets, checksums)
+            sources = [host for host in self.hosts
+                       if host not in first_bad or
+                       first_bad[host] == len(checksums)]
+            targets = [host for host, i_chunk in first_bad.iteritems()
+                       if i_chunk < len(checksums)]
+            if len(targets) == 0 or i_try == self.max_tries:
+                break
+            start_chunk = min(first_bad[host] for host in targets)
+            source = sources[0] if len(sources) > 0 else None
+            logger.info('Sending %s from chunk %s/%s to %s hosts',
+                        style.emph(self.image.split('/')[-1]), start_chunk,
+                        len(checksums), len(targets))
+            self._transfer(source, targets, start_chunk, size)
+            sent += (size - start_chunk * self.chunk_size * 2 ** 20) * \
+                len(targets)
+
+        self.failed_hosts = list(set(self.failed_hosts + targets))
+        if len(targets) == 0:
+            logger.info('%s has been broadcasted in %s, %.1f MB/s',
+                        style.emph(self.image.split('/')[-1]),
+                        timer.elapsed(),
+                        sent / 10. ** 6 / max(timer.elapsed(), 1))
+        else:
+            self.ok = False
+            logger.error('Unable to copy %s on %s', self.image,
+                         hosts_list(targets))
+
+    def _put_scripts(self):
+        """Copy on the hosts the scripts of scripts_contents"""
+        for name, content in self.scripts_contents:
+            fd, script = mkstemp(dir='/tmp/', prefix='vm5k_' + name + '_')
+            f = fdopen(fd, 'w')
+            f.write(content)
+            f.close()
+            self.scripts[name] = script
+        TaktukPut(self.hosts, self.scripts.values(),
+                  remote_location='/tmp/').run()
+
+    def _check_hosts(self, hosts, checksums):
+        """Return a dict whose keys are the hosts and values the index of
+        the first chunk of their copy that differs from the image"""
+        check = TaktukRemote('python ' + self.scripts['chunks'] + ' ' +
+                             self.remote_file + ' ' +
+                             str(self.chunk_size * 2 ** 20), hosts)
+        for p in check.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        check.run()
+        first_bad = {}
+        for p in check.processes:
+            host_checksums = p.stdout.split()
+            i_chunk = 0
+            while i_chunk < len(checksums) and \
+                    i_chunk < len(host_checksums) and \
+                    host_checksums[i_chunk] == checksums[i_chunk]:
+                i_chunk += 1
+            if p.exit_code != 0:
+                i_chunk = 0
+            elif i_chunk == len(checksums) and \
+                    len(host_checksums) > len(checksums):
+                i_chunk -= 1
+            first_bad[p.host.address] = i_chunk
+        return first_bad
+
+    def _fifo(self, child):
+        return '/tmp/vm5k_bcast_' + str(self.port) + '_' + child.split('.')[0]
+
+    def _fifos_cmd(self, children):
+        """Return the command that creates the fifos of the children"""
+        return ''.join(['rm -f ' + self._fifo(child) + ' ; mkfifo ' +
+                        self._fifo(child) + ' ; ' for child in children])
+
+    def _receive_cmd(self, children, start_chunk, size, source):
+        """Return the command that writes the stream in the copy of the
+        host and in the fifos of its children"""
+        fifos = [self._fifo(child) for child in children]
+        cmd = ('cat' if source else 'nc -l -p ' + str(self.port)) + ' | '
+        if fifos:
+            cmd += 'tee ' + ' '.join(fifos) + ' | '
+        if self.compression:
+            cmd += 'gunzip | '
+        if self.sparse:
+            cmd += 'python ' + self.scripts['receive'] + ' ' + \
+                self.remote_file + ' ' + \
+                str(start_chunk * self.chunk_size * 2 ** 20)
+        else:
+            cmd += 'dd of=' + self.remote_file + ' bs=1M seek=' + \
+                str(start_chunk * self.chunk_size) + ' conv=notrunc ' + \
+                'iflag=fullblock && truncate -s ' + str(size) + ' ' + \
+                self.remote_file
+        return cmd
+
+    def _send_cmd(self, image, start_chunk):
+        """Return the command that writes the stream of the image from
+        start_chunk on its standard output"""
+        if self.sparse:
+            cmd = 'python ' + self.scripts['send'] + ' ' + image + ' ' + \
+                str(start_chunk * self.chunk_size * 2 ** 20)
+        else:
+            cmd = 'dd if=' + image + ' bs=1M skip=' + \
+                str(start_chunk * self.chunk_size)
+        if self.compression:
+            cmd += ' | gzip -' + str(self.compression)
+        return cmd
+
+    def _forward_cmd(self, children):
+        """Return the command that sends the fifos to the children"""
+        return ' '.join(['nc -q 0 ' + child + ' ' + str(self.port) + ' < ' +
+                         self._fifo(child) + ' & ' for child in children]) + \
+            'wait ; rm -f ' + ' '.join(self._fifo(child)
+                                       for child in children)
+
+    def _transfer(self, source, targets, start_chunk, size):
+        """Send the image from start_chunk along the tree of the targets,
+        the first target being fed by the source through ssh"""
+        children = {host: targets[self.fanout * i + 1:
+                                  self.fanout * i + self.fanout + 1]
+                    for i, host in enumerate(targets)}
+        root = targets[0]
+        hosts_cmds = {host: self._fifos_cmd(children[host]) +
+                      self._receive_cmd(children[host], start_chunk, size,
+                                        False)
+                      for host in targets[1:]}
+        receive = None
+        if len(hosts_cmds) > 0:
+            receive = TaktukRemote('{{hosts_cmds.values()}}',
+                                   list(hosts_cmds.keys()))
+            for p in receive.processes:
+                p.ignore_exit_code = p.nolog_exit_code = True
+            receive.start()
+            TaktukRemote('until netstat -ltn | grep -q ":' + str(self.port) +
+                         ' " ; do sleep 0.1 ; done', list(hosts_cmds.keys()),
+                         process_args={'timeout': 60}).run()
+            forward_cmds = {host: self._forward_cmd(children[host])
+                            for host in targets[1:] if children[host]}
+            if len(forward_cmds) > 0:
+                forward = TaktukRemote('{{forward_cmds.values()}}',
+                                       list(forward_cmds.keys()))
+                for p in forward.processes:
+                    p.ignore_exit_code = p.nolog_exit_code = True
+                forward.start()
+
+        root_cmd = self._receive_cmd(children[root], start_chunk, size, True)
+        if children[root]:
+            root_cmd = self._fifos_cmd(children[root]) + \
+                '(' + self._forward_cmd(children[root]) + ') & ' + \
+                root_cmd + ' ; wait'
+        send_cmd = ' | ssh -o StrictHostKeyChecking=no root@' + root + \
+            ' "' + root_cmd + '"'
+        if source:
+            logger.detail('Sending from %s', style.host(source))
+            send = SshProcess(self._send_cmd(self.remote_file, start_chunk) +
+                              send_cmd, source)
+        else:
+            send = Process(self._send_cmd(self.image, start_chunk) + send_cmd,
+                           shell=True)
+        send.ignore_exit_code = send.nolog_exit_code = True
+        send.run()
+        outputs = [(root, send.stderr)]
+        if receive:
+            receive.wait()
+            outputs += [(p.host.address, p.stderr + p.stdout)
+                        for p in receive.processes]
+        self._get_throughput(outputs)
+
+    def _get_throughput(self, outputs):
+        """Update the MB/s of the link to each host from dd statistics"""
+        for host, output in outputs:
+            stats = re.search(r'(\d+) bytes .* copied, ([\d.,]+) s', output)
+            if stats:
+                duration = float(stats.group(2).replace(',', '.'))
+                self.throughput[host] = \
+                    int(stats.group(1)) / 10. ** 6 / max(duration, 0.001)
+        if len(self.throughput) > 0:
+            logger.detail('Throughput of the links (MB/s)\n%s',
+                          '\n'.join([host.split('.')[0] + ': %.1f' % rate
+                                     for host, rate in
+                                     sorted(self.throughput.iteritems())]))
+
+
+try:
+    _libc = ctypes.CDLL(find_library('c'), use_errno=True)
+    _libc.sendfile64.argtypes = [ctypes.c_int, ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_size_t]
+    _libc.sendfile64.restype = ctypes.c_ssize_t
+except (OSError, AttributeError, TypeError):
+    _libc = None
+
+
+def sendfile(out_fd, in_fd, offset, count):
+    """Send count bytes of in_fd from offset to out_fd, without copying
+    them in user space when the libc provides sendfile, and return the
+    number of bytes sent"""
+    if _libc is None:
+        lseek(in_fd, offset, SEEK_SET)
+        return write(out_fd, read(in_fd, min(count, 2 ** 20)))
+    c_offset = ctypes.c_int64(offset)
+    sent = _libc.sendfile64(out_fd, in_fd, ctypes.byref(c_offset), count)
+    if sent < 0:
+        errno = ctypes.get_errno()
+        raise OSError(errno, strerror(errno))
+    return sent
+
+
+class image_handler(BaseHTTPRequestHandler):
+    """Serve the images of the server, with support of the range
+    requests"""
+
+    def do_HEAD(self):
+        self._send_image(False)
+
+    def do_GET(self):
+        self._send_image(True)
+
+    def _send_image(self, body):
+        image = self.server.images.get(self.path.lstrip('/'))
+        if image is None:
+            self.send_error(404)
+            return
+        size = path.getsize(image)
+        start, end = 0, size - 1
+        ranges = re.match(r'bytes=(\d*)-(\d*)$',
+                          self.headers.get('Range', ''))
+        if ranges and (ranges.group(1) or ranges.group(2)):
+            if ranges.group(1):
+                start = int(ranges.group(1))
+                if ranges.group(2):
+                    end = min(int(ranges.group(2)), size - 1)
+            else:
+                start = max(0, size - int(ranges.group(2)))
+            if start >= size or start > end:
+                self.send_response(416)
+                self.send_header('Content-Range', 'bytes */%d' % size)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             'bytes %d-%d/%d' % (start, end, size))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/octet-stream')
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Content-Length', str(end - start + 1))
+        self.end_headers()
+        if not body:
+            return
+        self.wfile.flush()
+        with open(image, 'rb') as f:
+            remaining = end - start + 1
+            while remaining > 0:
+                sent = sendfile(self.connection.fileno(), f.fileno(), start,
+                                min(remaining, 2 ** 30))
+                if sent == 0:
+                    break
+                start += sent
+                remaining -= sent
+
+    def log_message(self, format, *args):
+        logger.debug('%s ' + format, self.client_address[0], *args)
+
+
+class image_server(ThreadingMixIn, HTTPServer):
+    """A HTTP server that serves images by their name, using sendfile
+    and range requests. It can be tested locally with address 127.0.0.1
+    and port 0 to get a free port."""
+    daemon_threads = True
+
+    def __init__(self, images, address='', port=8642):
+        """:param images: a list of paths of the images to serve
+
+        :param address: the address to listen on, all by default
+
+        :param port: the port to listen on, 0 for a free port
+        """
+        HTTPServer.__init__(self, (address, port), image_handler)
+        self.images = {image.split('/')[-1]: image for image in images}
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def url(self, image):
+        """Return the URL of the image, using the name of the frontend"""
+        return 'http://' + getfqdn() + ':' + str(self.port) + '/' + \
+            image.split('/')[-1]
+
+    def start(self):
+        """Serve the images in a background thread"""
+        self.thread = Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class image_pull(image_broadcast):
+    """Copy images on the hosts by making them download the images in
+    parallel from an image_server of the frontend, with resumed
+    downloads. The copies are checked and fixed by chunks as with
+    image_broadcast."""
+
+    def __init__(self, images, hosts, remote_dir='/tmp', chunk_size=64,
+                 port=8642, max_tries=3):
+        """:param images: a list of paths of images on the frontend
+
+        :param hosts: the hosts to copy the images on
+
+        :param remote_dir: directory of the hosts where an image is copied
+          as orig_<image name>
+
+        :param chunk_size: size of the checked chunks, in MiB
+
+        :param port: port of the image server
+
+        :param max_tries: number of downloads before giving up
+        """
+        image_broadcast.__init__(self, images, hosts, remote_dir,
+                                 chunk_size, port=port, max_tries=max_tries)
+        self.server = None
+
+    def run(self):
+        self.server = image_server(self.images, port=self.port).start()
+        try:
+            image_broadcast.run(self)
+        finally:
+            self.server.stop()
+
+    def _transfer(self, source, targets, start_chunk, size):
+        """Make the targets download the image from start_chunk"""
+        cmd = 'truncate -s ' + str(start_chunk * self.chunk_size * 2 ** 20) + \
+            ' ' + self.remote_file + ' ; wget -c --progress=dot:giga ' + \
+            '-O ' + self.remote_file + ' ' + self.server.url(self.image)
+        pull = TaktukRemote(cmd, targets)
+        for p in pull.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        pull.run()
+        self._get_throughput([(p.host.address, p.stderr + p.stdout)
+                              for p in pull.processes])
+
+    def _get_throughput(self, outputs):
+        """Update the MB/s of the download of each host from wget
+        statistics"""
+        units = {'B/s': 10 ** -6, 'KB/s': 10 ** -3, 'MB/s': 1, 'GB/s': 10 ** 3}
+        for host, output in outputs:
+            stats = re.findall(r'\(([\d.,]+) ([KMG]?B/s)\)', output)
+            if stats:
+                rate, unit = stats[-1]
+                self.throughput[host] = float(rate.replace(',', '.')) * \
+                    units[unit]
+
+
+class image_delta(image_broadcast):
+    """Update the copies of images that the hosts already have, by
+    sending them only the blocks that differ, as rsync does.
+
+    The hosts are grouped by the md5 of their copy. The signatures of the
+    blocks of a copy are computed by a host of each group, and are matched
+    on the frontend against the image with a rolling checksum. The
+    resulting gzipped delta is sent to the hosts of the group, which
+    rebuild the image from their copy and check its md5. A host without a
+    copy receives the whole image in the delta."""
+    scripts_contents = [('signature', signature_script),
+                        ('patch', patch_script)]
+
+    def __init__(self, images, hosts, remote_dir='/tmp',
+                 block_size=65536):
+        """:param images: a list of paths of images on the frontend
+
+        :param hosts: the hosts to update the images on
+
+        :param remote_dir: directory of the hosts where the copy of an
+          image is orig_<image name>
+
+        :param block_size: size of the compared blocks, in bytes
+        """
+        image_broadcast.__init__(self, images, hosts, remote_dir)
+        self.block_size = block_size
+
+    def _broadcast(self):
+        timer = Timer()
+        image_hash = Process('md5sum -b ' + self.image).run().stdout.split()[0]
+        check = TaktukRemote('md5sum -b ' + self.remote_file, self.hosts)
+        for p in check.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        check.run()
+        groups = {}
+        for p in check.processes:
+            copy_hash = p.stdout.split()[0] \
+                if p.exit_code == 0 and p.stdout else ''
+            if copy_hash != image_hash:
+                groups.setdefault(copy_hash, []).append(p.host.address)
+        if len(groups) == 0:
+            logger.info('%s is already present on all hosts',
+                        style.emph(self.image.split('/')[-1]))
+            return
+        sent = 0
+        for copy_hash, hosts in groups.iteritems():
+            signatures = self._get_signatures(hosts[0]) if copy_hash else []
+            fd, delta = mkstemp(dir='/tmp/', prefix='vm5k_delta_')
+            fdopen(fd).close()
+            try:
+                copied, literal = image_delta_file(self.image, signatures,
+                                                   self.block_size, delta)
+                logger.info('Sending a delta of %s MB of %s to %s hosts, '
+                            '%s MB reused from their copy',
+                            path.getsize(delta) / 10 ** 6,
+                            style.emph(self.image.split('/')[-1]),
+                            len(hosts), copied / 10 ** 6)
+                sent += path.getsize(delta) * len(hosts)
+                self._patch(hosts, delta, image_hash)
+            finally:
+                Process('rm -f ' + delta).run()
+        logger.info('%s has been updated in %s, %.1f MB sent',
+                    style.emph(self.image.split('/')[-1]), timer.elapsed(),
+                    sent / 10. ** 6)
+
+    def _get_signatures(self, host):
+        """Return the (adler32, md5) of the blocks of the copy of host"""
+        signature = SshProcess('python ' + self.scripts['signature'] + ' ' +
+                               self.remote_file + ' ' + str(self.block_size),
+                               host)
+        signature.ignore_exit_code = signature.nolog_exit_code = True
+        signature.run()
+        if signature.exit_code != 0:
+            return []
+        return [(int(weak), strong) for weak, strong in
+                [line.split() for line in signature.stdout.strip().split('\n')
+                 if line]]
+
+    def _patch(self, hosts, delta, image_hash):
+        """Send the delta to the hosts and rebuild their copy"""
+        TaktukPut(hosts, [delta], remote_location='/tmp/').run()
+        patch = TaktukRemote('touch ' + self.remote_file + ' ; python ' +
+                             self.scripts['patch'] + ' ' + self.remote_file +
+                             ' ' + delta + ' ' + image_hash + ' ; ' +
+                             'status=$? ; rm -f ' + delta + ' ; exit $status',
+                             hosts)
+        for p in patch.processes:
+            p.ignore_exit_code = p.nolog_exit_code = True
+        patch.run()
+        failed = [p.host.address for p in patch.processes
+                  if p.exit_code != 0]
+        if len(failed) > 0:
+            self.ok = False
+            self.failed_hosts = list(set(self.failed_hosts + failed))
+            logger.error('Unable to update %s on %s', self.image,
+                         hosts_list(failed))
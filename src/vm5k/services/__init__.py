@@ -16,6 +16,6 @@
 # You should have received a copy of the GNU General Public License
 # along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
 
-from dnsmasq import dnsmasq_server
+from dnsmasq import dnsmasq_server, dnsmasq_add_vms, dnsmasq_remove_vms
 from munin import setup_munin
 from aptcacher import setup_aptcacher_server, configure_apt_proxy
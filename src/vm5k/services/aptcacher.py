@@ -59,13 +59,16 @@ def setup_aptcacher_server(hosts, base_dir='/tmp/apt-cacher-ng'):
                 ','.join([style.host(host.address) for host in hosts]))
 
 
-def configure_apt_proxy(vms):
-    """Override apt proxy-guess with server as proxy"""
+def configure_apt_proxy(vms, servers=None):
+    """Override apt proxy-guess with server as proxy, the host of the VM
+    or its server if servers, a dict whose keys are hosts and values the
+    apt-cacher server of the host, is given"""
     hosts_vms = {}
     for vm in vms:
-        if not vm['host'] in hosts_vms:
-            hosts_vms[vm['host']] = []
-        hosts_vms[vm['host']].append(vm['ip'])
+        server = servers[vm['host']] if servers else vm['host']
+        if not server in hosts_vms:
+            hosts_vms[server] = []
+        hosts_vms[server].append(vm['ip'])
     conf = []
     for server, clients in hosts_vms.iteritems():
         server = Host(server)
@@ -4,37 +4,129 @@
 from os import fdopen
 from tempfile import mkstemp
 from math import ceil, log
-from execo import logger, SshProcess, Put, Remote, Host, TaktukRemote, \
+from socket import gethostbyname, inet_aton, inet_ntoa
+from struct import pack, unpack
+from execo import logger, SshProcess, Put, Host, TaktukRemote, \
     Process, TaktukPut
 from execo.log import style
 from execo_g5k import get_host_site
 
 
+# files read by dnsmasq at start and on SIGHUP to declare the VMs
+vms_hosts_file = '/etc/dnsmasq.vm5k.hosts'
+vms_dhcp_hosts_file = '/etc/dnsmasq.vm5k.dhcp-hosts'
+# upstream servers of dnsmasq, as the server resolv.conf points to itself
+upstream_resolv_file = '/etc/resolv.dnsmasq.conf'
+
+
+def _update_vms_files(server, vms, remove=False, dhcp=True):
+    """Replace the entries of the VMs in the addn-hosts and dhcp-hostsfile
+    of the server, or remove them, and reload dnsmasq with SIGHUP. The files
+    are rewritten in a temporary file then renamed, so that dnsmasq never
+    reads a partial file. Return False if several VMs have the same ip or
+    mac, without updating the server. Only the id of the VMs is used to
+    remove them."""
+    if len(vms) == 0:
+        return True
+    files = [mkstemp(dir='/tmp/', prefix=prefix)
+             for prefix in ['vms_names_', 'vms_hosts_', 'vms_dhcp_']]
+    f_names, f_hosts, f_dhcp = [fdopen(fd, 'w') for fd, _ in files]
+    files = [fname for _, fname in files]
+    ips, macs = set(), set()
+    duplicates = []
+    for vm in vms:
+        f_names.write(vm['id'] + '\n')
+        if remove:
+            continue
+        if vm['ip'] in ips or vm['mac'] in macs:
+            duplicates.append(vm['id'])
+        ips.add(vm['ip'])
+        macs.add(vm['mac'])
+        f_hosts.write(vm['ip'] + ' \t ' + vm['id'] + '\n')
+        f_dhcp.write(vm['mac'] + ',' + vm['id'] + ',' + vm['ip'] + '\n')
+    for f in [f_names, f_hosts, f_dhcp]:
+        f.close()
+    if duplicates:
+        logger.error('VMs %s have the ip or mac of another VM',
+                     ', '.join(duplicates))
+        Process('rm ' + ' '.join(files)).run()
+        return False
+
+    names, hosts, dhcp_hosts = ['/tmp/' + fname.split('/')[-1]
+                                for fname in files]
+    Put([server], files, remote_location='/tmp/').run()
+    # the name is the last field of an addn-hosts line and the second one
+    # of a dhcp-hostsfile line
+    confs = [(vms_hosts_file, hosts, "'NR == FNR {n[$0] ; next} "
+              "!($NF in n)'")]
+    if dhcp:
+        confs.append((vms_dhcp_hosts_file, dhcp_hosts,
+                      "-F, 'NR == FNR {n[$0] ; next} !($2 in n)'"))
+    cmd = ''
+    for conf, entries, awk_filter in confs:
+        cmd += 'touch ' + conf + ' ; awk ' + awk_filter + ' ' + names + \
+            ' ' + conf + ' > ' + conf + '.new ; '
+        if not remove:
+            cmd += 'cat ' + entries + ' >> ' + conf + '.new ; '
+        cmd += 'mv ' + conf + '.new ' + conf + ' ; '
+    cmd += 'rm ' + ' '.join([names, hosts, dhcp_hosts]) + ' ; ' + \
+        'pkill -HUP -x dnsmasq ; true'
+    SshProcess(cmd, server).run()
+    Process('rm ' + ' '.join(files)).run()
+    return True
+
+
+def dnsmasq_add_vms(server, vms, dhcp=True):
+    """Declare the VMs in the DNS and DHCP of a running dnsmasq server,
+    without restarting it nor disturbing the other VMs
+
+    :param dhcp: if False, the VMs are only declared in the DNS, as done
+      for the VMs served by another service node
+    """
+    logger.debug('Adding %s VMs in dnsmasq on %s', len(vms),
+                 style.host(server))
+    return _update_vms_files(server, vms, dhcp=dhcp)
+
+
+def dnsmasq_remove_vms(server, vms):
+    """Remove the VMs from the DNS and DHCP of a running dnsmasq server
+
+    :param vms: a list of VMs dicts, of which only the id is used
+    """
+    logger.debug('Removing %s VMs from dnsmasq on %s', len(vms),
+                 style.host(server))
+    _update_vms_files(server, vms, remove=True)
+
+
 def add_vms(vms, server):
     """Generate the list of virtual machines """
-    logger.debug('Adding the VM in /etc/hosts ...')
-    fd, vms_list = mkstemp(dir='/tmp/', prefix='vms_')
-    f = fdopen(fd, 'w')
-    f.write('\n' + '\n'.join([vm['ip'] + ' \t ' + vm['id'] for vm in vms]))
-    f.close()
-    Put([server], [vms_list], remote_location='/etc/').run()
-    SshProcess('[ -f /etc/hosts.bak ] && cp /etc/hosts.bak /etc/hosts || ' +
-               ' cp /etc/hosts /etc/hosts.bak', server).run()
-    Remote('cat /etc/' + vms_list.split('/')[-1] + ' >> /etc/hosts',
-           [server]).run()
-    Process('rm ' + vms_list).run()
+    return dnsmasq_add_vms(server, vms)
+
+
+_servers_ip = {}
 
 
 def get_server_ip(host):
-    """Get the server IP"""
+    """Get the server IP, resolved once by host"""
     if isinstance(host, Host):
         host = host.address
-    logger.debug('Retrieving IP from %s', style.host(host))
-    get_ip = Process('host ' + host + ' |cut -d \' \' -f 4')
-    get_ip.shell = True
-    get_ip.run()
-    ip = get_ip.stdout.strip()
-    return ip
+    if host not in _servers_ip:
+        logger.debug('Retrieving IP from %s', style.host(host))
+        _servers_ip[host] = gethostbyname(host)
+    return _servers_ip[host]
+
+
+def get_dhcp_ranges(ips):
+    """Return the list of (first, last) ip of the contiguous ranges
+    covering the given ips"""
+    ranges = []
+    for ip_int in sorted(set(unpack('!I', inet_aton(ip))[0] for ip in ips)):
+        if ranges and ip_int == ranges[-1][1] + 1:
+            ranges[-1][1] = ip_int
+        else:
+            ranges.append([ip_int, ip_int])
+    return [(inet_ntoa(pack('!I', first)), inet_ntoa(pack('!I', last)))
+            for first, last in ranges]
 
 
 def get_server_iface(server):
@@ -63,25 +155,45 @@ def resolv_conf(server, clients, sites):
 
 def dhcp_conf(server, vms, sites):
     """Generate the dnsmasq.conf with dhcp parameters and
-    put it on the server"""
+    put it on the server, return True if it has changed"""
     logger.debug('Creating dnsmasq.conf')
-    ip_mac = [(vm['ip'], vm['mac']) for vm in vms]
-    dhcp_lease = 'dhcp-lease-max=10000\n'
-    dhcp_range = 'dhcp-range=' + ip_mac[0][0] + ',' + ip_mac[len(vms) - 1][0] + ',12h\n'
-    dhcp_router = 'dhcp-option=option:router,' + get_server_ip(server) + '\n'
-    dhcp_hosts = '' + '\n'.join(['dhcp-host=' + ':' + ip_mac[i][1] + ',' +
-                               vms[i]['id'] + ',' + ip_mac[i][0]
-                               for i in range(len(vms))])
-    dhcp_option = 'dhcp-option=option:domain-search,grid5000.fr,' + \
-        ','.join([site + '.grid5000.fr' for site in sites]) + '\n'
     fd, dnsmasq = mkstemp(dir='/tmp/', prefix='dnsmasq_')
     f = fdopen(fd, 'w')
-    f.write(dhcp_lease + dhcp_range + dhcp_router + dhcp_hosts + '\n' + dhcp_option)
+    f.write('dhcp-lease-max=' + str(max(10000, len(vms))) + '\n' +
+            'dhcp-ignore=tag:!known\n')
+    for first, last in get_dhcp_ranges(vm['ip'] for vm in vms):
+        f.write('dhcp-range=' + first + ',' + last + ',12h\n')
+    f.write('dhcp-option=option:router,' + get_server_ip(server) + '\n' +
+            'addn-hosts=' + vms_hosts_file + '\n' +
+            'dhcp-hostsfile=' + vms_dhcp_hosts_file + '\n' +
+            'resolv-file=' + upstream_resolv_file + '\n' +
+            'dhcp-option=option:domain-search,grid5000.fr,' +
+            ','.join([site + '.grid5000.fr' for site in sites]) + '\n')
     f.close()
     Put([server], [dnsmasq], remote_location='/etc/').run()
-    SshProcess('cd /etc && cp ' + dnsmasq.split('/')[-1]+' dnsmasq.conf',
-               server).run()
     Process('rm ' + dnsmasq).run()
+    return _replace_conf(server, '/etc/' + dnsmasq.split('/')[-1])
+
+
+def dns_conf(server):
+    """Generate a dnsmasq.conf that only declare the VMs hosts file and
+    put it on the server, return True if it has changed"""
+    logger.debug('Creating dnsmasq.conf')
+    SshProcess('echo "addn-hosts=' + vms_hosts_file + '" > ' +
+               '/etc/dnsmasq.conf.vm5k ; echo "resolv-file=' +
+               upstream_resolv_file + '" >> /etc/dnsmasq.conf.vm5k',
+               server).run()
+    return _replace_conf(server, '/etc/dnsmasq.conf.vm5k')
+
+
+def _replace_conf(server, conf):
+    """Replace the dnsmasq.conf of the server by conf, and return True if
+    it has changed, i.e. if dnsmasq must be restarted"""
+    replace = SshProcess('if cmp -s ' + conf + ' /etc/dnsmasq.conf ; ' +
+                         'then rm ' + conf + ' ; else mv ' + conf +
+                         ' /etc/dnsmasq.conf && echo changed ; fi',
+                         server).run()
+    return 'changed' in replace.stdout
 
 
 def sysctl_conf(server, vms):
@@ -101,8 +213,10 @@ def sysctl_conf(server, vms):
     Process('rm '+sysctl).run()
 
 
-def dnsmasq_server(server, clients=None, vms=None, dhcp=True):
-    """Configure a DHCP server with dnsmasq
+def dnsmasq_server(server, clients=None, vms=None, dhcp=True, dns_vms=None):
+    """Configure a DHCP server with dnsmasq. It is restarted only on its
+    first configuration or if its dnsmasq.conf changes, otherwise the VMs
+    are updated in place and dnsmasq is reloaded.
 
     :param server: host where the server will be installed
 
@@ -110,13 +224,17 @@ def dnsmasq_server(server, clients=None, vms=None, dhcp=True):
 
     :param vms: list of virtual machines
 
+    :param dns_vms: list of virtual machines served by other servers, that
+      are only declared in the DNS
+
     """
     logger.debug('Installing and configuring a DNS/DHCP server on %s', server)
 
     test_running = Process('nmap ' + server + ' -p 53 | grep domain')
     test_running.shell = True
     test_running.run()
-    if 'open' in test_running.stdout:
+    running = 'open' in test_running.stdout
+    if running:
         logger.info('DNS server already running, updating configuration')
     else:
         cmd = 'killall dnsmasq; export DEBIAN_MASTER=noninteractive ; ' + \
@@ -128,7 +246,6 @@ def dnsmasq_server(server, clients=None, vms=None, dhcp=True):
 
     sites = list(set([get_host_site(client) for client in clients
                       if get_host_site(client)] + [get_host_site(server)]))
-    add_vms(vms, server)
     if clients:
         kill_dnsmasq = TaktukRemote('killall dnsmasq', clients)
         for p in kill_dnsmasq.processes:
@@ -138,9 +255,31 @@ def dnsmasq_server(server, clients=None, vms=None, dhcp=True):
 
     if dhcp:
         sysctl_conf(server, vms)
-        dhcp_conf(server, vms, sites)
+        changed = dhcp_conf(server, vms, sites)
+    else:
+        changed = dns_conf(server)
+    restart = not running or changed
+    SshProcess('[ -f ' + upstream_resolv_file + ' ] || ' +
+               'cp /etc/resolv.conf ' + upstream_resolv_file, server).run()
+    resolv_conf(server, [server], sites)
+    if restart:
+        SshProcess('rm -f ' + vms_hosts_file + ' ' + vms_dhcp_hosts_file,
+                   server).run()
+    else:
+        # only the VMs that are no longer declared are removed, so that
+        # the running server keeps answering for the others
+        vms_ids = set(vm['id'] for vm in vms + (dns_vms if dns_vms else []))
+        names = SshProcess('touch ' + vms_hosts_file + ' ; ' +
+                           'awk \'{print $NF}\' ' + vms_hosts_file,
+                           server).run().stdout.split()
+        dnsmasq_remove_vms(server, [{'id': name} for name in names
+                                    if name not in vms_ids])
+    dnsmasq_add_vms(server, vms)
+    if dns_vms:
+        dnsmasq_add_vms(server, dns_vms, dhcp=False)
 
-    logger.debug('Restarting service ...')
-    cmd = 'service dnsmasq stop ; rm /var/lib/misc/dnsmasq.leases ; ' + \
-        'service dnsmasq start',
-    SshProcess(cmd, server).run()
+    if restart:
+        logger.debug('Restarting service ...')
+        cmd = 'service dnsmasq stop ; rm /var/lib/misc/dnsmasq.leases ; ' + \
+            'service dnsmasq start'
+        SshProcess(cmd, server).run()
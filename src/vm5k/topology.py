@@ -0,0 +1,268 @@
+# Copyright 2012-2014 INRIA Rhone-Alpes, Service Experimentation et
+# Developpement
+#
+# This file is part of Vm5k.
+#
+# Vm5k is free software: you can redistribute it and/or modify it
+# under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Vm5k is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public
+# License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Vm5k.  If not, see <http://www.gnu.org/licenses/>
+"""Determine the CPU topology of the Grid'5000 clusters, from a cache
+shared by all the experiments, from the reference API or from a node"""
+import json
+from os import path, makedirs
+from xml.etree.ElementTree import fromstring, parse
+from execo import SshProcess, logger
+from execo.log import style
+from execo_g5k import default_frontend_connection_params, OarSubmission, \
+    oarsub, oardel, get_oar_job_nodes, wait_oar_job_start, get_cluster_site
+from execo_g5k.api_utils import get_cluster_hosts, get_host_attributes
+from vm5k.config import topology_dir
+
+
+class host_topology():
+    """The CPU topology of a host, described by the list of its logical
+    CPU, each one being a dict with keys ``id``, ``socket``, ``core`` and
+    ``cell``, and by the list of its caches, a dict with keys ``level``,
+    ``size`` (in bytes, None if unknown) and ``cpus``."""
+
+    def __init__(self, cpus=None, caches=None, source=None):
+        self.cpus = sorted(cpus if cpus else [], key=lambda cpu: cpu['id'])
+        self.caches = caches if caches else []
+        self.source = source
+
+    @property
+    def sockets(self):
+        """The list of the sockets id"""
+        return sorted(set(cpu['socket'] for cpu in self.cpus))
+
+    @property
+    def cores(self):
+        """The list of the physical cores, as (socket, core) tuples"""
+        return sorted(set((cpu['socket'], cpu['core']) for cpu in self.cpus))
+
+    @property
+    def siblings(self):
+        """A dict whose keys are the physical cores and values the list of
+        their SMT siblings"""
+        siblings = {}
+        for cpu in self.cpus:
+            siblings.setdefault((cpu['socket'], cpu['core']),
+                                []).append(cpu['id'])
+        return siblings
+
+    @property
+    def cells(self):
+        """A dict whose keys are the NUMA cells and values their CPU"""
+        cells = {}
+        for cpu in self.cpus:
+            cells.setdefault(cpu['cell'], []).append(cpu['id'])
+        return cells
+
+    def cells_cpus(self):
+        """Return the list of the CPU of each cell, ordered by cell"""
+        cells = self.cells
+        return [cells[cell] for cell in sorted(cells)]
+
+    def to_dict(self):
+        return {'cpus': self.cpus, 'caches': self.caches,
+                'source': self.source}
+
+    @classmethod
+    def from_dict(cls, topo):
+        return cls(topo['cpus'], topo['caches'], topo.get('source'))
+
+    def __repr__(self):
+        return 'host_topology(%s sockets, %s cores, %s cpus, %s cells)' % \
+            (len(self.sockets), len(self.cores), len(self.cpus),
+             len(self.cells))
+
+
+def _parse_cpu_list(cpus):
+    """Convert a string like 0-3,8 into a list of CPU id"""
+    cpu_ids = []
+    for cpu_range in cpus.split(','):
+        if '-' in cpu_range:
+            first, last = cpu_range.split('-')
+            cpu_ids += range(int(first), int(last) + 1)
+        elif cpu_range:
+            cpu_ids.append(int(cpu_range))
+    return cpu_ids
+
+
+def _format_cpu_list(cpu_ids):
+    """Convert a list of CPU id into a string like 0-3,8"""
+    ranges = []
+    for cpu_id in sorted(set(cpu_ids)):
+        if ranges and cpu_id == ranges[-1][1] + 1:
+            ranges[-1][1] = cpu_id
+        else:
+            ranges.append([cpu_id, cpu_id])
+    return ','.join(str(first) if first == last else '%s-%s' % (first, last)
+                    for first, last in ranges)
+
+
+def parse_virsh_capabilities(capabilities):
+    """Return a host_topology from the output of ``virsh capabilities``
+    (a string or an XML element). Libvirt versions that do not give the
+    socket and core of the CPU are handled by considering each CPU as a
+    core of a socket per cell."""
+    root = fromstring(capabilities) if isinstance(capabilities, basestring) \
+        else capabilities
+    cpus = []
+    for cell in root.findall('.//topology/cells/cell'):
+        for cpu in cell.findall('.//cpu'):
+            cpu_id = int(cpu.get('id'))
+            cpus.append({'id': cpu_id,
+                         'socket': int(cpu.get('socket_id', cell.get('id'))),
+                         'core': int(cpu.get('core_id', cpu_id)),
+                         'cell': int(cell.get('id'))})
+    units = {'KiB': 2 ** 10, 'MiB': 2 ** 20, 'GiB': 2 ** 30}
+    caches = []
+    for bank in root.findall('.//cache/bank'):
+        caches.append({'level': 'L' + bank.get('level'),
+                       'size': int(bank.get('size')) *
+                       units.get(bank.get('unit'), 1),
+                       'cpus': _parse_cpu_list(bank.get('cpus'))})
+    return host_topology(cpus, caches, 'virsh')
+
+
+def parse_lscpu(lscpu):
+    """Return a host_topology from the output of ``lscpu -p``, whose
+    columns are given by its last comment line. The caches are the groups
+    of CPU sharing the same cache id, with an unknown size."""
+    columns = None
+    rows = []
+    for line in lscpu.strip().split('\n'):
+        if line.startswith('#'):
+            columns = [col.strip().lower() for col in line[1:].split(',')]
+        elif line.strip():
+            rows.append(line.strip().split(','))
+    if columns is None:
+        columns = ['cpu', 'core', 'socket', 'node']
+    cpus = []
+    groups = {}
+    for row in rows:
+        values = dict(zip(columns, row))
+        cpu_id = int(values['cpu'])
+        cpus.append({'id': cpu_id,
+                     'socket': int(values.get('socket') or 0),
+                     'core': int(values.get('core') or cpu_id),
+                     'cell': int(values.get('node') or 0)})
+        for col, value in values.iteritems():
+            if col.startswith('l') and col[1:2].isdigit() and value:
+                groups.setdefault((col.upper(), value), []).append(cpu_id)
+    caches = [{'level': level, 'size': None, 'cpus': cpus_ids}
+              for (level, _), cpus_ids in sorted(groups.iteritems())]
+    return host_topology(cpus, caches, 'lscpu')
+
+
+def api_topology(cluster):
+    """Return a host_topology built from the reference API description of
+    the first host of the cluster, or None if the API does not give the
+    CPU numbering. One NUMA cell per socket is assumed."""
+    attr = get_host_attributes(get_cluster_hosts(cluster)[0])
+    arch = attr['architecture']
+    numbering = arch.get('cpu_core_numbering')
+    n_sockets = arch['nb_procs']
+    n_cores = arch['nb_cores'] / n_sockets
+    n_threads = arch.get('nb_threads', arch['nb_cores']) / arch['nb_cores']
+    cpus = []
+    for socket in range(n_sockets):
+        for core in range(n_cores):
+            for thread in range(n_threads):
+                if numbering == 'contiguous':
+                    cpu_id = (thread * n_sockets + socket) * n_cores + core
+                elif numbering == 'round-robin':
+                    cpu_id = (thread * n_cores + core) * n_sockets + socket
+                elif numbering == 'contiguous-grouped-by-threads':
+                    cpu_id = (socket * n_cores + core) * n_threads + thread
+                else:
+                    return None
+                cpus.append({'id': cpu_id, 'socket': socket, 'core': core,
+                             'cell': socket})
+    caches = []
+    for level in ['l1d', 'l1i', 'l2', 'l3']:
+        size = attr.get('processor', {}).get('cache_' + level)
+        if size:
+            caches.append({'level': level.upper(), 'size': size,
+                           'cpus': None})
+    return host_topology(cpus, caches, 'api')
+
+
+def probe_topology(cluster):
+    """Reserve a node of the cluster and return its host_topology from
+    virsh capabilities, or lscpu if libvirt is not installed. Raise a
+    RuntimeError if the node gives no CPU, so that nothing is cached."""
+    frontend = get_cluster_site(cluster)
+    submission = OarSubmission(
+        resources="{cluster='" + cluster + "'}/nodes=1",
+        walltime="0:02:00",
+        job_type="allow_classic_ssh")
+    ((job_id, _), ) = oarsub([(submission, frontend)])
+    try:
+        wait_oar_job_start(job_id, frontend)
+        host = get_oar_job_nodes(job_id, frontend)[0]
+        probe = SshProcess('virsh capabilities 2>/dev/null || lscpu -p', host,
+            connection_params={'user': default_frontend_connection_params['user']}
+            ).run()
+    finally:
+        oardel([(job_id, frontend)])
+    topology = None
+    if probe.ok and probe.stdout.strip().startswith('<'):
+        topology = parse_virsh_capabilities(probe.stdout)
+    elif probe.ok and probe.stdout.strip():
+        topology = parse_lscpu(probe.stdout)
+    if topology is None or len(topology.cpus) == 0:
+        raise RuntimeError('Unable to probe the topology of %s' % cluster)
+    return topology
+
+
+def get_host_topology(cluster, xpdir=None, use_api=True, need_cells=False):
+    """Return the host_topology of a cluster, read from the topology cache,
+    or from a topo_<cluster>.xml file of xpdir, or from the reference API,
+    or by probing a node. The result is stored in the topology cache.
+
+    :param cluster: a Grid'5000 cluster
+
+    :param xpdir: an experiment directory containing virsh capabilities
+
+    :param use_api: use the reference API before probing a node
+
+    :param need_cells: the NUMA cells must be exact, so a topology that
+     comes from the reference API is replaced by a probed one
+    """
+    fname = path.join(topology_dir, cluster + '.json')
+    if path.exists(fname):
+        with open(fname) as f:
+            topology = host_topology.from_dict(json.load(f))
+        if not need_cells or topology.source != 'api':
+            return topology
+
+    if need_cells:
+        use_api = False
+    topology = None
+    if xpdir and path.exists(xpdir + '/topo_' + cluster + '.xml'):
+        topology = parse_virsh_capabilities(
+            parse(xpdir + '/topo_' + cluster + '.xml').getroot())
+    if topology is None and use_api:
+        topology = api_topology(cluster)
+    if topology is None:
+        logger.info('No topology found for %s, will reserve a node ' +
+                    'to determine it', style.emph(cluster))
+        topology = probe_topology(cluster)
+
+    if not path.exists(topology_dir):
+        makedirs(topology_dir)
+    with open(fname, 'w') as f:
+        json.dump(topology.to_dict(), f)
+    logger.debug('%s: %s', cluster, topology)
+    return topology
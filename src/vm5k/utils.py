@@ -18,20 +18,25 @@
 
 import re
 import copy
-from os import fdopen
-from tempfile import mkstemp
+from errno import EINPROGRESS, EWOULDBLOCK
+from select import select
+from socket import socket, gethostbyname, error as socket_error, AF_INET, \
+    SOCK_STREAM, SOL_SOCKET, SO_ERROR, inet_ntoa
+from struct import pack
+from time import time
 from pprint import pformat
 from xml.dom import minidom
 from random import randint
 from itertools import cycle
 from math import floor
-from execo import logger, Host, Process, Timer, Remote, sleep
+from multiprocessing.pool import ThreadPool
+from execo import logger, Host, Timer, Remote, sleep
 from execo.log import style
 from execo_g5k import get_oar_job_nodes, get_oargrid_job_oar_jobs, \
     get_oar_job_subnets, get_oar_job_kavlan, wait_oar_job_start, \
     wait_oargrid_job_start, distribute_hosts, get_planning, \
-    OarSubmission
-from execo.time_utils import get_seconds
+    OarSubmission, get_oar_job_info
+from execo.time_utils import get_seconds, format_duration
 from execo_g5k.api_utils import get_host_cluster, get_g5k_clusters, \
     get_host_attributes, get_resource_attributes, get_cluster_site, \
     get_g5k_sites, get_site_clusters, get_host_site
@@ -41,90 +46,261 @@ from xml.etree.ElementTree import tostring
 from execo_g5k.utils import get_ipv4_range, get_mac_addresses, hosts_list
 
 
-def reboot_hosts(hosts, timeout=300):
-    """ """
+def reboot_hosts(hosts, timeout=300, kexec=False):
+    """Reboot the hosts and wait until they are back, return True if all
+    the hosts have rebooted
+
+    :param kexec: reload the running kernel with kexec to skip the
+      firmware, and reboot normally the hosts where it has failed
+    """
+    if kexec:
+        hosts = _kexec_reboot_hosts(hosts, timeout)
+        if len(hosts) == 0:
+            return True
+        logger.warning('kexec has failed on %s, rebooting them',
+                       hosts_list(hosts))
     reboot = Remote('reboot', hosts).run()
     if not reboot.ok:
         return False
     wait_hosts_down(hosts, timeout)
-    wait_hosts_up(hosts, timeout)
+    return wait_hosts_up(hosts, timeout)
+
+
+def _kexec_reboot_hosts(hosts, timeout=300):
+    """Reboot the hosts on their running kernel with kexec, check that
+    they are back with the same kernel and a new boot id, and return the
+    list of hosts where it has failed. Without systemd, the loaded kernel
+    is executed after a sync, as the kexec-tools init script may not be
+    enabled and a normal reboot would go through the firmware."""
+    hosts = map(lambda x: x.address if isinstance(x, Host) else x, hosts)
+    cmd_kernel = 'uname -r ; cat /proc/sys/kernel/random/boot_id'
+    get_kernel = Remote(cmd_kernel, hosts).run()
+    kernels = {p.host.address: p.stdout.split() for p in get_kernel.processes
+               if p.ok}
+
+    logger.detail('Loading the running kernel with kexec')
+    cmd = "which kexec > /dev/null || (echo 'kexec-tools " + \
+        "kexec-tools/load_kexec boolean true' | debconf-set-selections ; " + \
+        "export DEBIAN_FRONTEND=noninteractive ; " + \
+        "apt-get install -y kexec-tools > /dev/null) ; " + \
+        'kexec -l /boot/vmlinuz-`uname -r` ' + \
+        '--initrd=/boot/initrd.img-`uname -r` ' + \
+        '--append="`cat /proc/cmdline`" && ' + \
+        '(nohup sh -c "sleep 1 ; sync ; if which systemctl > /dev/null ; ' + \
+        'then systemctl kexec ; else kexec -e ; fi" > /dev/null 2>&1 &)'
+    load = Remote(cmd, kernels.keys()).run()
+    loaded = [p.host.address for p in load.processes if p.ok]
+    wait_hosts_down(loaded, timeout)
+    wait_hosts_up(loaded, timeout)
+
+    check = Remote(cmd_kernel, loaded)
+    for p in check.processes:
+        p.ignore_exit_code = p.nolog_exit_code = True
+    check.run()
+    rebooted = []
+    for p in check.processes:
+        host = p.host.address
+        kernel = p.stdout.split()
+        if p.ok and len(kernel) == 2 and kernel[0] == kernels[host][0] \
+                and kernel[1] != kernels[host][1]:
+            rebooted.append(host)
+        else:
+            logger.warning('%s has not rebooted on kernel %s',
+                           style.host(host), kernels[host][0])
+    logger.detail('%s hosts rebooted with kexec', len(rebooted))
+    return [host for host in hosts if host not in rebooted]
+
+
+def get_hosts_ips(hosts, max_threads=32):
+    """Resolve the hosts names in parallel and return a dict whose keys are
+    the hosts and values their IP, or the host name if it cannot be
+    resolved"""
+    hosts = map(lambda x: x.address if isinstance(x, Host) else x, hosts)
+    if len(hosts) == 0:
+        return {}
 
+    def _resolve(host):
+        try:
+            return gethostbyname(host)
+        except socket_error:
+            logger.warning('Unable to resolve %s', style.host(host))
+            return host
 
-def wait_hosts_down(hosts, timeout=300):
-    """ """
+    pool = ThreadPool(min(len(hosts), max_threads))
+    try:
+        ips = pool.map(_resolve, hosts)
+    finally:
+        pool.close()
+    return dict(zip(hosts, ips))
+
+
+def check_hosts_port(ips, port=22, timeout=2, max_connections=256):
+    """Return the set of IP accepting a TCP connection on port, using
+    non-blocking connects, with at most max_connections at the same time
+
+    :param ips: a list of IP or names, those that do not resolve being
+      considered as closed
+
+    :param timeout: time given to a batch of connections to be established
+    """
+    opened = set()
+    for i in range(0, len(ips), max_connections):
+        pending = {}
+        for ip in ips[i:i + max_connections]:
+            sock = socket(AF_INET, SOCK_STREAM)
+            sock.setblocking(0)
+            try:
+                err = sock.connect_ex((ip, port))
+            except socket_error:
+                # an unresolvable name is a host down
+                sock.close()
+                continue
+            if err == 0:
+                opened.add(ip)
+                sock.close()
+            elif err in (EINPROGRESS, EWOULDBLOCK):
+                pending[sock] = ip
+            else:
+                sock.close()
+        end = time() + timeout
+        while len(pending) > 0 and time() < end:
+            _, writable, _ = select([], pending.keys(), [],
+                                    max(0, end - time()))
+            for sock in writable:
+                if sock.getsockopt(SOL_SOCKET, SO_ERROR) == 0:
+                    opened.add(pending[sock])
+                sock.close()
+                del pending[sock]
+        for sock in pending:
+            sock.close()
+    return opened
+
+
+def wait_hosts_state(hosts, state='up', timeout=300, interval=1, port=22,
+                     callback=None):
+    """Wait until all the hosts are up or down, i.e. accept or refuse
+    connections on the SSH port. Return True if all the hosts have reached
+    the state before the timeout.
+
+    :param hosts: a list of hosts
+
+    :param state: ``up`` or ``down``
+
+    :param interval: delay between two checks of the hosts
+
+    :param callback: a function called with the host and the state when
+      a host reaches the state
+    """
+    hosts = map(lambda x: x.address if isinstance(x, Host) else x, hosts)
+    ips = get_hosts_ips(hosts)
+    waited_hosts = list(hosts)
     timer = Timer()
-    up_hosts = map(lambda x: x.address if isinstance(x, Host) else x,
-                   hosts)
-    fd, hosts_file = mkstemp(dir='/tmp/', prefix='hosts_')
-    with fdopen(fd, 'w') as f:
-        f.write('\n' + '\n'.join(up_hosts))
-
-    while len(up_hosts) > 0 and timer.elapsed() < timeout:
-        nmap = Process("nmap -v -oG - -i %s -p 22 |grep Host|grep Status" %
-                       (hosts_file, ), shell=True).run()
-        logger.debug('timer: %s \nnmap output: \n%s', timer.elapsed(),
-                     nmap.stdout.strip())
-        for line in nmap.stdout.strip().split('\n'):
-            if 'Down' in line:
-                ip = line.split()[1]
-                get_host = Process('host ' + ip + '| cut -f 5 -d " "',
-                                   shell=True).run()
-                host = get_host.stdout.strip()[0:-1]
-                if host in up_hosts:
-                    logger.detail(host + ' is down')
-                    up_hosts.remove(host)
-    Process('rm ' + hosts_file).run()
-
-    return len(up_hosts) == 0
-
-
-def wait_hosts_up(hosts, timeout=300):
-    """ """
-    down_hosts = map(lambda x: x.address if isinstance(x, Host) else x,
-                     hosts)
-    fd, hosts_file = mkstemp(dir='/tmp/', prefix='hosts_')
-    f = fdopen(fd, 'w')
-    f.write('\n' + '\n'.join(down_hosts))
-    f.close()
+    while len(waited_hosts) > 0 and timer.elapsed() < timeout:
+        opened = check_hosts_port([ips[host] for host in waited_hosts], port)
+        for host in list(waited_hosts):
+            if (ips[host] in opened) == (state == 'up'):
+                logger.detail('%s is %s', host, state)
+                waited_hosts.remove(host)
+                if callback:
+                    callback(host, state)
+        if len(waited_hosts) > 0:
+            sleep(interval)
+    logger.debug('%s hosts %s after %s', len(hosts) - len(waited_hosts),
+                 state, format_duration(timer.elapsed()))
+    return len(waited_hosts) == 0
+
+
+def wait_hosts_down(hosts, timeout=300, callback=None):
+    """Wait until all the hosts have stopped answering on port 22"""
+    return wait_hosts_state(hosts, 'down', timeout, callback=callback)
+
+
+def wait_hosts_up(hosts, timeout=300, callback=None):
+    """Wait until all the hosts answer on port 22"""
+    return wait_hosts_state(hosts, 'up', timeout, callback=callback)
+
+
+# seconds waited for a job after its scheduled start
+start_margin = 600
+
+
+def _get_site_vm5k_resources(oar_job_id, site, timeout=None):
+    """Wait for the job start and return the resources of a site, or None
+    if the job has not started or the API calls failed. Without timeout,
+    the job must start at most start_margin seconds after its scheduled
+    start."""
     timer = Timer()
-    while len(down_hosts) > 0 and timer.elapsed() < timeout:
-        nmap = Process("nmap -v -oG - -i %s -p 22 |grep Host|grep Status" %
-                       (hosts_file, ), shell=True).run()
-        logger.debug('timer: %s \nnmap output: \n%s', timer.elapsed(),
-                     nmap.stdout.strip())
-        for line in nmap.stdout.strip().split('\n'):
-            s = line.split()[2]
-            host = s[s.find("(") + 1:s.find(")")]
-            if host in down_hosts:
-                logger.detail('%s is up', host)
-                down_hosts.remove(host)
-    Process('rm ' + hosts_file).run()
-    sleep(3)
-    return len(down_hosts) == 0
-
-
-def get_oar_job_vm5k_resources(jobs):
-    """Retrieve the hosts list and (ip, mac) list from a list of oar_job and
-    return the resources dict needed by vm5k_deployment """
-    resources = {}
-    for oar_job_id, site in jobs:
+    try:
         logger.detail('Retrieving resources from %s:%s',
                       style.emph(site), oar_job_id)
         oar_job_id = int(oar_job_id)
-        wait_oar_job_start(oar_job_id, site)
+        if timeout is None:
+            scheduled_start = get_oar_job_info(oar_job_id,
+                                               site).get('scheduled_start')
+            timeout = start_margin + (max(0, scheduled_start - time())
+                                      if scheduled_start else 0)
+        if wait_oar_job_start(oar_job_id, site, timeout=timeout) is False:
+            logger.error('Job %s has not started on %s', oar_job_id,
+                         style.emph(site))
+            return None
         logger.debug('Retrieving hosts')
         hosts = [host.address for host in get_oar_job_nodes(oar_job_id, site)]
         logger.debug('Retrieving subnet')
-        ip_mac, _ = get_oar_job_subnets(oar_job_id, site)
+        ip_mac, network_params = get_oar_job_subnets(oar_job_id, site)
+        network = {'netmask': network_params.get('netmask'),
+                   'gateway': network_params.get('gateway'),
+                   'dns': network_params.get('dns_ip')}
         kavlan = None
         if len(ip_mac) == 0:
             logger.debug('Retrieving kavlan')
             kavlan = get_oar_job_kavlan(oar_job_id, site)
             if kavlan:
                 ip_mac = get_kavlan_ip_mac(kavlan, site)
-        resources[site] = {'hosts': hosts,
-                           'ip_mac': ip_mac[300:],
-                           'kavlan': kavlan}
+                _, mask_size = get_kavlan_network(kavlan, site)
+                # the service node is the gateway and dns of the kavlan
+                network = {'netmask': inet_ntoa(pack('!I', (2 ** 32 - 1) ^
+                                                (2 ** (32 - int(mask_size)) - 1))),
+                           'gateway': None, 'dns': None}
+        return {'hosts': hosts,
+                'ip_mac': ip_mac[300:],
+                'kavlan': kavlan,
+                'network': network}
+    except Exception, e:
+        logger.error('Unable to retrieve resources from %s:%s, %s',
+                     style.emph(site), oar_job_id, e)
+        return None
+    finally:
+        logger.detail('Resources of %s retrieved in %s', style.emph(site),
+                      format_duration(timer.elapsed()))
+
+
+def get_oar_job_vm5k_resources(jobs, timeout=None, max_threads=10):
+    """Retrieve the hosts list and (ip, mac) list from a list of oar_job and
+    return the resources dict needed by vm5k_deployment. The sites are
+    treated concurrently and those whose job fail to start or whose API
+    calls fail are not in the resources dict.
+
+    :param jobs: a list of tuple (oar_job_id, site)
+
+    :param timeout: maximum duration of the wait for the jobs start, by
+      default start_margin seconds after their scheduled start
+
+    :param max_threads: maximum number of sites treated in parallel
+    """
+    resources = {}
+    if len(jobs) == 0:
+        return resources
+    pool = ThreadPool(min(len(jobs), max_threads))
+    try:
+        sites_resources = pool.map(lambda job:
+                                   _get_site_vm5k_resources(job[0], job[1],
+                                                            timeout),
+                                   jobs)
+    finally:
+        pool.close()
+    for (_, site), site_resources in zip(jobs, sites_resources):
+        if site_resources is not None:
+            resources[site] = site_resources
     return resources
 
 
@@ -143,6 +319,7 @@ def get_oargrid_job_vm5k_resources(oargrid_job_id):
         if res['kavlan'] >= 10:
             kavlan_global = {'kavlan': res['kavlan'],
                              'ip_mac': resources[site]['ip_mac'],
+                             'network': resources[site]['network'],
                              'site': site}
             break
     if kavlan_global:
@@ -0,0 +1,52 @@
+import unittest
+from vm5k.actions import define_vms, qcow2_options, network_options, \
+    get_net_queues
+
+
+def define_vm(**params):
+    return define_vms(['vm-1'], ip_mac=[('10.0.0.1', '00:16:3e:00:00:01')],
+                      **params)[0]
+
+
+class test_qcow2_options(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual(qcow2_options(define_vm()), 'cluster_size=65536')
+
+    def test_options(self):
+        vm = define_vm(cluster_size=2097152, preallocation='metadata',
+                       lazy_refcounts=True)
+        self.assertEqual(qcow2_options(vm),
+                         'cluster_size=2097152,preallocation=metadata,'
+                         'compat=1.1,lazy_refcounts=on')
+
+    def test_preallocated_overlay(self):
+        vm = define_vm(preallocation='metadata')
+        self.assertRaises(ValueError, qcow2_options, vm, backing_file=True)
+        self.assertEqual(qcow2_options(define_vm(), backing_file=True),
+                         'cluster_size=65536')
+
+
+class test_network_options(unittest.TestCase):
+
+    def test_default(self):
+        self.assertEqual(network_options(define_vm()),
+                         'network=default,mac=00:16:3e:00:00:01')
+
+    def test_queues(self):
+        vm = define_vm(n_cpu=4, net_queues='auto', net_driver='vhost')
+        self.assertEqual(get_net_queues(vm), 4)
+        self.assertEqual(network_options(vm),
+                         'network=default,mac=00:16:3e:00:00:01,'
+                         'model=virtio,driver_name=vhost,driver_queues=4')
+
+    def test_single_queue_driver(self):
+        vm = define_vm(net_driver='qemu', mtu=9000)
+        self.assertEqual(get_net_queues(vm), 1)
+        self.assertEqual(network_options(vm),
+                         'network=default,mac=00:16:3e:00:00:01,'
+                         'model=virtio,driver_name=qemu')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+import unittest
+import httplib
+import shutil
+import subprocess
+import sys
+import tempfile
+from hashlib import md5
+from os import path, urandom
+from zlib import adler32
+from vm5k.images import image_delta_file, patch_script, image_server
+
+
+def signatures(copy, block_size):
+    with open(copy, 'rb') as f:
+        data = f.read()
+    return [(adler32(data[i:i + block_size]) & 0xffffffff,
+             md5(data[i:i + block_size]).hexdigest())
+            for i in range(0, len(data), block_size)]
+
+
+class test_image_delta(unittest.TestCase):
+
+    block_size = 4096
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.script = path.join(self.dir, 'patch.py')
+        with open(self.script, 'w') as f:
+            f.write(patch_script)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, name, data):
+        fname = path.join(self.dir, name)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        return fname
+
+    def patch(self, old, new, image_hash=None):
+        """Rebuild new from old with the delta and the patch script, and
+        return the exit code of the script and the stats of the delta"""
+        copy = self.write('copy', old)
+        image = self.write('image', new)
+        delta = path.join(self.dir, 'delta.gz')
+        stats = image_delta_file(image, signatures(copy, self.block_size),
+                                 self.block_size, delta)
+        status = subprocess.call([sys.executable, self.script, copy, delta,
+                                  image_hash or md5(new).hexdigest()])
+        with open(copy, 'rb') as f:
+            return status, stats, f.read()
+
+    def test_insertion(self):
+        old = urandom(20 * self.block_size)
+        new = old[:5 * self.block_size + 100] + urandom(50) + \
+            old[5 * self.block_size + 100:]
+        status, (copied, literal), result = self.patch(old, new)
+        self.assertEqual(status, 0)
+        self.assertEqual(result, new)
+        self.assertTrue(literal < 2 * self.block_size)
+        self.assertEqual(copied + literal, len(new))
+
+    def test_truncation_and_zeros(self):
+        old = urandom(10 * self.block_size)
+        new = old[:3 * self.block_size] + chr(0) * 2 * self.block_size + \
+            old[3 * self.block_size:6 * self.block_size]
+        status, _, result = self.patch(old, new)
+        self.assertEqual(status, 0)
+        self.assertEqual(result, new)
+
+    def test_empty_copy(self):
+        new = urandom(3 * self.block_size + 7)
+        status, (copied, literal), result = self.patch('', new)
+        self.assertEqual(status, 0)
+        self.assertEqual((copied, literal), (0, len(new)))
+        self.assertEqual(result, new)
+
+    def test_bad_checksum(self):
+        old = urandom(4 * self.block_size)
+        new = urandom(4 * self.block_size)
+        status, _, result = self.patch(old, new, md5('').hexdigest())
+        self.assertEqual(status, 1)
+        self.assertEqual(result, old)
+        self.assertFalse(path.exists(path.join(self.dir, 'copy.new')))
+
+
+class test_image_server(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.data = urandom(1000)
+        self.image = path.join(self.dir, 'image.qcow2')
+        with open(self.image, 'wb') as f:
+            f.write(self.data)
+        self.server = image_server([self.image], '127.0.0.1', 0).start()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def get(self, name='image.qcow2', byte_range=None):
+        connection = httplib.HTTPConnection('127.0.0.1', self.server.port)
+        headers = {'Range': byte_range} if byte_range else {}
+        connection.request('GET', '/' + name, headers=headers)
+        response = connection.getresponse()
+        body = response.read()
+        connection.close()
+        return response, body
+
+    def test_full(self):
+        response, body = self.get()
+        self.assertEqual(response.status, 200)
+        self.assertEqual(body, self.data)
+
+    def test_ranges(self):
+        response, body = self.get(byte_range='bytes=10-19')
+        self.assertEqual(response.status, 206)
+        self.assertEqual(response.getheader('Content-Range'),
+                         'bytes 10-19/1000')
+        self.assertEqual(body, self.data[10:20])
+        response, body = self.get(byte_range='bytes=990-')
+        self.assertEqual(body, self.data[990:])
+        response, body = self.get(byte_range='bytes=-5')
+        self.assertEqual(body, self.data[-5:])
+        response, body = self.get(byte_range='bytes=900-2000')
+        self.assertEqual(body, self.data[900:])
+
+    def test_unsatisfiable_range(self):
+        response, body = self.get(byte_range='bytes=1000-')
+        self.assertEqual(response.status, 416)
+        self.assertEqual(response.getheader('Content-Range'), 'bytes */1000')
+
+    def test_unknown_image(self):
+        response, _ = self.get('other.qcow2')
+        self.assertEqual(response.status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import unittest
+from vm5k.topology import host_topology, parse_lscpu, \
+    parse_virsh_capabilities, _parse_cpu_list, _format_cpu_list
+
+
+lscpu = """# The following is the parsable format, which can be fed to other
+# programs. Each different item in every column has an unique ID
+# starting from zero.
+# CPU,Core,Socket,Node,,L1d,L1i,L2,L3
+0,0,0,0,,0,0,0,0
+1,1,0,0,,1,1,1,0
+2,2,1,1,,2,2,2,1
+3,3,1,1,,3,3,3,1
+4,0,0,0,,0,0,0,0
+5,1,0,0,,1,1,1,0
+6,2,1,1,,2,2,2,1
+7,3,1,1,,3,3,3,1
+"""
+
+capabilities = """<capabilities>
+  <host>
+    <topology>
+      <cells num='2'>
+        <cell id='0'>
+          <cpus num='2'>
+            <cpu id='0' socket_id='0' core_id='0' siblings='0,2'/>
+            <cpu id='2' socket_id='0' core_id='0' siblings='0,2'/>
+          </cpus>
+        </cell>
+        <cell id='1'>
+          <cpus num='2'>
+            <cpu id='1' socket_id='1' core_id='0' siblings='1,3'/>
+            <cpu id='3' socket_id='1' core_id='0' siblings='1,3'/>
+          </cpus>
+        </cell>
+      </cells>
+    </topology>
+    <cache>
+      <bank id='0' level='3' type='both' size='20' unit='MiB' cpus='0,2'/>
+      <bank id='1' level='3' type='both' size='20' unit='MiB' cpus='1,3'/>
+    </cache>
+  </host>
+</capabilities>"""
+
+
+class test_cpu_list(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(_parse_cpu_list('0-3,8'), [0, 1, 2, 3, 8])
+        self.assertEqual(_parse_cpu_list(''), [])
+
+    def test_format(self):
+        self.assertEqual(_format_cpu_list([0, 1, 3, 5, 6, 7]), '0-1,3,5-7')
+        self.assertEqual(_format_cpu_list([2, 2]), '2')
+        self.assertEqual(_format_cpu_list([]), '')
+
+    def test_round_trip(self):
+        cpus = [0, 1, 2, 4, 8, 9, 10, 15]
+        self.assertEqual(_parse_cpu_list(_format_cpu_list(cpus)), cpus)
+
+
+class test_parse_lscpu(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = parse_lscpu(lscpu)
+
+    def test_cpus(self):
+        self.assertEqual(self.topology.source, 'lscpu')
+        self.assertEqual(len(self.topology.cpus), 8)
+        self.assertEqual(self.topology.sockets, [0, 1])
+        self.assertEqual(len(self.topology.cores), 4)
+        self.assertEqual(self.topology.siblings[(0, 0)], [0, 4])
+
+    def test_cells(self):
+        self.assertEqual(self.topology.cells_cpus(),
+                         [[0, 1, 4, 5], [2, 3, 6, 7]])
+
+    def test_caches(self):
+        l3 = [cache for cache in self.topology.caches
+              if cache['level'] == 'L3']
+        self.assertEqual(sorted(cache['cpus'] for cache in l3),
+                         [[0, 1, 4, 5], [2, 3, 6, 7]])
+        self.assertTrue(all(cache['size'] is None for cache in l3))
+
+    def test_without_header(self):
+        topology = parse_lscpu('0,0,0,0\n1,1,0,0\n')
+        self.assertEqual(topology.cells_cpus(), [[0, 1]])
+
+
+class test_parse_virsh_capabilities(unittest.TestCase):
+
+    def setUp(self):
+        self.topology = parse_virsh_capabilities(capabilities)
+
+    def test_cpus(self):
+        self.assertEqual(self.topology.source, 'virsh')
+        self.assertEqual([cpu['id'] for cpu in self.topology.cpus],
+                         [0, 1, 2, 3])
+        self.assertEqual(self.topology.siblings, {(0, 0): [0, 2],
+                                                  (1, 0): [1, 3]})
+
+    def test_cells(self):
+        self.assertEqual(self.topology.cells, {0: [0, 2], 1: [1, 3]})
+
+    def test_caches(self):
+        self.assertEqual(self.topology.caches,
+                         [{'level': 'L3', 'size': 20 * 2 ** 20,
+                           'cpus': [0, 2]},
+                          {'level': 'L3', 'size': 20 * 2 ** 20,
+                           'cpus': [1, 3]}])
+
+    def test_dict_round_trip(self):
+        topology = host_topology.from_dict(self.topology.to_dict())
+        self.assertEqual(topology.cpus, self.topology.cpus)
+        self.assertEqual(topology.caches, self.topology.caches)
+        self.assertEqual(topology.source, 'virsh')
+
+
+if __name__ == '__main__':
+    unittest.main()